@@ -64,6 +64,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'machines.middleware.MachinesMemoMiddleware',
 )
 
 
@@ -135,5 +136,91 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'cache_table',
-    }
-}
\ No newline at end of file
+    },
+    # rendered templates, keyed by the version of what they show. They never get stale, old versions are evicted
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fragments',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv("MACHINERY_FRAGMENT_CACHE_ENTRIES", 1000)),
+        },
+    },
+}
+
+# docker-machine
+
+# where machines_ls gets the machine details from. "cli" runs `docker-machine inspect` for every machine, "store" reads
+# the machine store of docker-machine from disk and falls back to the CLI if that fails
+MACHINERY_INVENTORY_BACKEND = os.getenv("MACHINERY_INVENTORY_BACKEND", "cli")
+
+# storage path of docker-machine, uses the same default as docker-machine
+MACHINERY_STORAGE_PATH = os.getenv("MACHINE_STORAGE_PATH", os.path.join(os.path.expanduser("~"), ".docker", "machine"))
+
+# seconds between two scans of the machine store if inotify isn't available
+MACHINERY_WATCH_INTERVAL = float(os.getenv("MACHINERY_WATCH_INTERVAL", 2))
+
+# seconds between two full refreshes of the machine cache
+MACHINERY_REFRESH_INTERVAL = float(os.getenv("MACHINERY_REFRESH_INTERVAL", 60))
+
+# seconds between two refreshes of machines that are in a transitional or unknown state
+MACHINERY_REFRESH_TRANSITIONAL_INTERVAL = float(os.getenv("MACHINERY_REFRESH_TRANSITIONAL_INTERVAL", 5))
+
+# seconds after which the cached list of machines is refreshed in the background. Until the refresh is done, the stale
+# list is used
+MACHINERY_INVENTORY_SOFT_TTL = float(os.getenv("MACHINERY_INVENTORY_SOFT_TTL", 90))
+
+# seconds after which the cached list of machines is dropped and has to be refreshed before it can be used again
+MACHINERY_INVENTORY_HARD_TTL = int(os.getenv("MACHINERY_INVENTORY_HARD_TTL", 60*5))
+
+# maximum number of docker-machine processes that run at the same time
+MACHINERY_COMMAND_WORKERS = int(os.getenv("MACHINERY_COMMAND_WORKERS", 8))
+
+# seconds docker-machine ls may take before it is killed
+MACHINERY_LS_TIMEOUT = float(os.getenv("MACHINERY_LS_TIMEOUT", 60))
+
+# seconds docker-machine inspect, ip and url may take before they are killed. The machine is then listed as "timeout"
+MACHINERY_COMMAND_TIMEOUT = float(os.getenv("MACHINERY_COMMAND_TIMEOUT", 20))
+
+# seconds docker-machine rm may take before it is killed
+MACHINERY_RM_TIMEOUT = float(os.getenv("MACHINERY_RM_TIMEOUT", 120))
+
+# seconds a job (e.g. docker-machine create) may take before it is killed
+MACHINERY_RUN_TIMEOUT = float(os.getenv("MACHINERY_RUN_TIMEOUT", 60*60))
+
+# number of jobs (e.g. docker-machine create) that run at the same time
+MACHINERY_JOB_WORKERS = int(os.getenv("MACHINERY_JOB_WORKERS", 4))
+
+# directory the output of jobs is stored in
+MACHINERY_JOB_LOG_ROOT = os.path.join(MEDIA_ROOT, "jobs")
+
+# bytes of job output that are buffered before they are written to the log
+MACHINERY_JOB_LOG_FLUSH_SIZE = int(os.getenv("MACHINERY_JOB_LOG_FLUSH_SIZE", 4096))
+
+# seconds job output is buffered at most before it is written to the log
+MACHINERY_JOB_LOG_FLUSH_INTERVAL = float(os.getenv("MACHINERY_JOB_LOG_FLUSH_INTERVAL", 1))
+
+# seconds between two heartbeats on an idle event stream
+MACHINERY_STREAM_HEARTBEAT = float(os.getenv("MACHINERY_STREAM_HEARTBEAT", 15))
+
+# seconds an event stream stays open, browsers reconnect afterwards
+MACHINERY_STREAM_DURATION = float(os.getenv("MACHINERY_STREAM_DURATION", 60*5))
+
+# number of threads of the server, every open event stream holds one
+MACHINERY_THREAD_POOL = int(os.getenv("MACHINERY_THREAD_POOL", 30))
+
+# maximum number of event streams open at the same time, the remaining threads are left for all other requests
+MACHINERY_MAX_STREAMS = int(os.getenv("MACHINERY_MAX_STREAMS", MACHINERY_THREAD_POOL - 10))
+
+# seconds a browser waits before it tries again if there are too many open event streams
+MACHINERY_STREAM_RETRY = float(os.getenv("MACHINERY_STREAM_RETRY", 30))
+
+# machines per page of the JSON API, if the client doesn't ask for a number
+MACHINERY_API_PAGE_SIZE = int(os.getenv("MACHINERY_API_PAGE_SIZE", 100))
+
+# maximum number of machines per page of the JSON API
+MACHINERY_API_MAX_PAGE_SIZE = int(os.getenv("MACHINERY_API_MAX_PAGE_SIZE", 1000))
+
+# when nothing is cached and docker-machine can't filter, filtered lists ask the matching machines from the machine
+# store for their state one at a time. If more machines match, all machines are listed with a single ls instead
+MACHINERY_STORE_FILTER_MAX_MACHINES = int(os.getenv("MACHINERY_STORE_FILTER_MAX_MACHINES", 5))
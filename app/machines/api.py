@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+JSON API for the list of machines.
+
+Machines are returned as compact records (name, state, driver, ip and url), the raw inspect payload is only added if
+it's asked for with `?inspect=1`. Filters are applied before anything is inspected, see core.find_machines.
+
+Lists can be filtered, sorted and are paginated with cursors: every page links to the next one with an opaque cursor
+that encodes the sort key of its last machine, so pages stay stable while machines are added or removed.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import base64
+import json
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.generic import View
+
+from .changes import current_version, summary
+from .core import find_machines, get_inspect_many, get_inventory
+from .inventory import INDEXES
+
+# fields machines can be sorted by, prefix them with "-" to sort descending
+SORT_FIELDS = ("name", "state", "driver")
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def error_response(message, status=400):
+    return JsonResponse({"error": message}, status=status)
+
+
+def record(machine, inspect=False):
+    """
+    Build the API record of a machine.
+
+    :param machine: Machine
+    :param inspect: add the raw inspect payload
+    :return: dict
+    """
+    data = summary(machine)
+    if inspect:
+        data["inspect"] = machine.inspect
+    return data
+
+
+def records(machines, inspect=False):
+    """
+    Build the API records of several machines. Their inspect payloads are loaded together, see get_inspect_many.
+
+    :param machines: list of machines
+    :param inspect: add the raw inspect payload
+    :return: list of dicts
+    """
+    data = [summary(machine) for machine in machines]
+    if inspect:
+        # machines that timed out don't have any details
+        inspects = get_inspect_many([machine.name for machine in machines if machine.state != "timeout"])
+        for item in data:
+            item["inspect"] = inspects.get(item["name"], {})
+    return data
+
+
+def sort_key(data, field):
+    """
+    :param data: API record of a machine
+    :param field: field to sort by
+    :return: tuple, the name breaks ties so that every machine has its own key
+    """
+    return data[field] or "", data["name"]
+
+
+def encode_cursor(sort, key):
+    return base64.urlsafe_b64encode(json.dumps([sort, list(key)]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, sort):
+    """
+    :param cursor: cursor of a previous page
+    :param sort: sort order of the current request, it has to match the one of the cursor
+    :return: tuple, the sort key of the last machine on the previous page
+    """
+    try:
+        cursor_sort, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidQuery("invalid cursor")
+    if cursor_sort != sort:
+        raise InvalidQuery("the cursor belongs to a different sort order")
+    return tuple(key)
+
+
+def get_flag(request, name):
+    return request.GET.get(name, "").lower() in ("1", "true", "yes")
+
+
+def get_limit(request):
+    """
+    :return: int, the number of machines asked for. Raises InvalidQuery if it's not between 1 and
+             MACHINERY_API_MAX_PAGE_SIZE
+    """
+    try:
+        limit = int(request.GET.get("limit", settings.MACHINERY_API_PAGE_SIZE))
+    except ValueError:
+        raise InvalidQuery("limit has to be an integer")
+    if not 0 < limit <= settings.MACHINERY_API_MAX_PAGE_SIZE:
+        raise InvalidQuery("limit has to be between 1 and {0}".format(settings.MACHINERY_API_MAX_PAGE_SIZE))
+    return limit
+
+
+def get_filters(request):
+    """
+    :return: dict mapping the secondary indexes of the inventory to the values asked for, see Inventory.find
+    """
+    return dict((field, request.GET.getlist(field)) for field in INDEXES if request.GET.getlist(field))
+
+
+class MachineListAPIView(View):
+    """
+    List machines.
+
+    Query parameters:
+
+    - name: only machines whose name contains the value
+    - state, driver, swarm_role, swarm_master: only machines with this value, can be given more than once
+    - sort: name, state or driver, prefixed with "-" for descending order. Defaults to name
+    - limit: machines per page, at most MACHINERY_API_MAX_PAGE_SIZE
+    - cursor: `next` of the previous page
+    - inspect: add the raw inspect payload to every machine
+    """
+
+    def get(self, request):
+        try:
+            page = self.page(request)
+        except InvalidQuery as e:
+            return error_response(str(e))
+        return JsonResponse(page)
+
+    def page(self, request):
+        sort = request.GET.get("sort", "name")
+        field = sort.lstrip("-")
+        if field not in SORT_FIELDS:
+            raise InvalidQuery("sort has to be one of {0}".format(", ".join(SORT_FIELDS)))
+        descending = sort.startswith("-")
+
+        limit = get_limit(request)
+
+        cursor = request.GET.get("cursor")
+        after = decode_cursor(cursor, sort) if cursor else None
+
+        # read the version first. If the list changes in between, the client sees a newer list, never an older one
+        version = current_version()
+        machines, age = find_machines(request.GET.get("name", ""), **get_filters(request))
+        inspect = get_flag(request, "inspect")
+
+        matches = [(sort_key(summary(machine), field), machine) for machine in machines]
+        matches.sort(key=lambda match: match[0], reverse=descending)
+
+        if after is not None:
+            if descending:
+                matches = [match for match in matches if match[0] < after]
+            else:
+                matches = [match for match in matches if match[0] > after]
+
+        items = matches[:limit]
+        return {
+            "version": version,
+            "age": age,
+            "machines": records([machine for key, machine in items], inspect=inspect),
+            "next": encode_cursor(sort, items[-1][0]) if len(matches) > limit else None,
+        }
+
+
+class MachineDetailAPIView(View):
+    """
+    Get a single machine. Pass `?inspect=1` to add the raw inspect payload.
+
+    The machine is looked up in the inventory, unknown names don't run docker-machine.
+    """
+
+    def get(self, request, name):
+        machine = get_inventory().get(name)
+        if machine is None:
+            return error_response("no machine named {0}".format(name), status=404)
+        return JsonResponse(record(machine, inspect=get_flag(request, "inspect")))
+
+
+class MachineSearchAPIView(View):
+    """
+    Search machines by name.
+
+    Query parameters:
+
+    - q: part of the machine name. Exact matches come first, then machines whose name starts with it
+    - state, driver, swarm_role, swarm_master: only machines with this value, can be given more than once
+    - limit: maximum number of machines, at most MACHINERY_API_MAX_PAGE_SIZE
+    - inspect: add the raw inspect payload to every machine
+    """
+
+    def get(self, request):
+        try:
+            limit = get_limit(request)
+        except InvalidQuery as e:
+            return error_response(str(e))
+
+        version = current_version()
+        machines, age = find_machines(request.GET.get("q", ""), **get_filters(request))
+        inspect = get_flag(request, "inspect")
+        return JsonResponse({
+            "version": version,
+            "count": len(machines),
+            "machines": records(machines[:limit], inspect=inspect),
+        })
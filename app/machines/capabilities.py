@@ -0,0 +1,106 @@
+"""
+This module finds out what the installed docker-machine binary supports.
+
+Older versions of docker-machine don't know `ls --format`, `ls --filter` or `ls --timeout`, and only newer ones inspect
+more than one machine at a time. The binary is probed once with `--help`, the result is kept for as long as the binary
+doesn't change (same path and mtime), so an upgrade of docker-machine is noticed without a restart. The core module
+uses the capabilities to pick the fastest way to talk to docker-machine and keeps the old way for older binaries.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import re
+import threading
+from collections import namedtuple
+from django.conf import settings
+from .executor import CommandTimeout, execute
+
+Capabilities = namedtuple("Capabilities", ["ls_format", "ls_filter", "ls_timeout", "inspect_many"])
+
+# what is assumed if the binary can't be probed, the code paths every version supports
+NO_CAPABILITIES = Capabilities(ls_format=False, ls_filter=False, ls_timeout=False, inspect_many=False)
+
+_capabilities = {}
+_lock = threading.Lock()
+
+
+def get_capabilities(binary):
+    """
+    Get the capabilities of a docker-machine binary, it is probed the first time it's asked for.
+
+    :param binary: path of the docker-machine binary
+    :return: Capabilities
+    """
+    try:
+        key = (os.path.realpath(binary), os.path.getmtime(binary))
+    except OSError:
+        return NO_CAPABILITIES
+
+    with _lock:
+        capabilities = _capabilities.get(key)
+    if capabilities is not None:
+        return capabilities
+
+    try:
+        capabilities = probe(binary)
+    except (CommandTimeout, OSError):
+        # try again next time
+        return NO_CAPABILITIES
+
+    with _lock:
+        # a new mtime means a new binary, the old entries are of no use anymore
+        for old in [old for old in _capabilities if old[0] == key[0]]:
+            del _capabilities[old]
+        _capabilities[key] = capabilities
+    return capabilities
+
+
+def probe(binary):
+    """
+    Probe a docker-machine binary by reading the help of `ls` and `inspect`.
+
+    :param binary: path of the docker-machine binary
+    :return: Capabilities
+    """
+    ls_help = command_help(binary, "ls")
+    return Capabilities(
+        ls_format=has_flag(ls_help, "format"),
+        ls_filter=has_flag(ls_help, "filter"),
+        ls_timeout=has_flag(ls_help, "timeout"),
+        # e.g. "Usage: docker-machine inspect [OPTIONS] MACHINE [MACHINE...]", older versions print "[arg...]" for
+        # every command, even if they only take one argument
+        inspect_many="MACHINE..." in usage(command_help(binary, "inspect")).upper(),
+    )
+
+
+def command_help(binary, command):
+    """
+    :param binary: path of the docker-machine binary
+    :param command: docker-machine command
+    :return: str, the help of the command. Some versions print it to stderr
+    """
+    returncode, out, err = execute([binary, command, "--help"], timeout=settings.MACHINERY_COMMAND_TIMEOUT)
+    return out + err
+
+
+def has_flag(text, flag):
+    return re.search(r"(^|[\s,])--{0}\b".format(flag), text, re.MULTILINE) is not None
+
+
+def usage(text):
+    """
+    :return: the usage line of a help text, empty if there is none
+    """
+    for line in text.splitlines():
+        if line.strip().lower().startswith("usage:"):
+            return line
+    return ""
+
+
+def forget():
+    """
+    Drop all probed capabilities.
+    """
+    with _lock:
+        _capabilities.clear()
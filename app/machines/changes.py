@@ -0,0 +1,141 @@
+"""
+This module tracks changes to the list of machines.
+
+Whenever the cached list of machines is written, it is compared to the previous list. If machines were added, removed
+or changed, the inventory version is bumped, the change is recorded and everybody waiting for a change (e.g. the
+inventory stream) is woken up.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+
+# number of changes that are kept, clients that are further behind get a reset
+HISTORY = 100
+
+_changed = threading.Condition()
+# versions keep growing across restarts, so that clients never see a version twice
+_version = [int(time.time() * 1000)]
+_history = deque(maxlen=HISTORY)
+
+
+def summary(machine):
+    """
+    The parts of a machine that are shown in the list of machines.
+
+    :param machine: Machine
+    :return: dict
+    """
+    return {
+        "name": machine.name,
+        "state": machine.state,
+        "driver": machine.driver,
+        "ip": machine.ip,
+        "url": machine.url,
+    }
+
+
+def row_hash(machine):
+    """
+    Hash of the parts of a machine that are shown in the list of machines. The row of a machine only has to be rendered
+    again if its hash changed.
+
+    :param machine: Machine
+    :return: str
+    """
+    return hashlib.sha1(json.dumps(summary(machine), sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def diff(previous, current):
+    """
+    Compare two lists of machines.
+
+    :param previous: list of machines
+    :param current: list of machines
+    :return: dict with the names of the added and removed machines and the summaries of the changed machines
+    """
+    previous = dict((machine.name, summary(machine)) for machine in previous)
+    current = dict((machine.name, summary(machine)) for machine in current)
+
+    return {
+        "added": sorted(name for name in current if name not in previous),
+        "removed": sorted(name for name in previous if name not in current),
+        "changed": [current[name] for name in sorted(current) if name in previous and previous[name] != current[name]],
+    }
+
+
+def record(previous, current):
+    """
+    Record the change between two lists of machines. Nothing is recorded if they are the same.
+
+    :param previous: list of machines, None if there was no list before
+    :param current: list of machines
+    :return: the current version
+    """
+    change = diff(previous or [], current)
+
+    with _changed:
+        if change["added"] or change["removed"] or change["changed"]:
+            _version[0] += 1
+            change["version"] = _version[0]
+            _history.append(change)
+            _changed.notify_all()
+        return _version[0]
+
+
+def current_version():
+    """
+    :return: int, the version of the list of machines
+    """
+    with _changed:
+        return _version[0]
+
+
+def changes_since(version):
+    """
+    Get the changes made after a version.
+
+    :param version: int
+    :return: list of changes, oldest first. None if the history doesn't go back that far
+    """
+    with _changed:
+        if version == _version[0]:
+            return []
+        if version > _version[0] or not _history or _history[0]["version"] > version + 1:
+            return None
+        return [change for change in _history if change["version"] > version]
+
+
+def merge(changes):
+    """
+    Merge consecutive changes.
+
+    :param changes: list of changes, oldest first
+    :return: tuple (names of the machines that were new to the first change, names of all machines that were added,
+             removed or changed)
+    """
+    added, touched = set(), set()
+    for change in changes:
+        added.update(name for name in change["added"] if name not in touched)
+        touched.update(change["added"])
+        touched.update(change["removed"])
+        touched.update(machine["name"] for machine in change["changed"])
+    return added, touched
+
+
+def wait_for_change(version, timeout):
+    """
+    Wait until the list of machines changes.
+
+    :param version: the version the caller knows
+    :param timeout: seconds to wait at most
+    :return: tuple (the new version, True if anything changed)
+    """
+    with _changed:
+        if _version[0] == version:
+            _changed.wait(timeout)
+        return _version[0], _version[0] != version
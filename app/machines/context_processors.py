@@ -1,12 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+from django.conf import settings
 from django.core.urlresolvers import reverse
-from .core import machines_ls
+from django.utils.functional import SimpleLazyObject
+from .core import last_known_machines
+from .changes import current_version
 
 
 def machine_cache_context_processor(request):
     """
-    Basic context processor to populate the context with a cached list of machines.
+    Basic context processor to populate the context with a cached list of machines, its age in seconds and its version.
+
+    The list and its age are lazy, the cache is only read if a template uses them. Both share a single lookup, the list
+    is memoized for the duration of the request.
     """
-    return {"machines": machines_ls(cached=True),
-            "sidebar_url": reverse("machines:list-sidebar-partial")}
\ No newline at end of file
+    # read the version first. If the list changes in between, the client gets the change once more instead of missing it
+    version = current_version()
+    return {"machines": SimpleLazyObject(lambda: last_known_machines()[0]),
+            "machines_age": SimpleLazyObject(lambda: last_known_machines()[1]),
+            "machines_version": version,
+            "sidebar_url": reverse("machines:list-sidebar-partial"),
+            "inventory_stream_url": reverse("machines:list-stream"),
+            # milliseconds to wait before reconnecting if the server has too many open streams
+            "inventory_stream_retry": int(settings.MACHINERY_STREAM_RETRY * 1000)}
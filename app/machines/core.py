@@ -2,110 +2,754 @@
 This module implements a interface to docker-machine.
 
 The current implementation is based on the docker-machine command line interface. The long term goal is to get rid of
-the CLI and to support libmachine (through python bindings) out of the box.
+the CLI and to support libmachine (through python bindings) out of the box. Machine details can already be read from the
+machine store on disk, see the store module.
+
+All docker-machine commands (except for the long running ones started by jobs) run on the executor, see the executor
+module. The functions in this module wait for their commands to finish.
 """
 
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 import subprocess
 import json
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+from django.conf import settings
 from django.core.cache import cache
-from drivers.models import driver_class_by_name
+from django.db import connection
+from django.utils.six.moves.urllib.parse import urlparse
+from . import changes
+from .capabilities import get_capabilities
+from .executor import BACKGROUND, CommandFailed, CommandTimeout, Watchdog, execute, lane, spawn
+from .inventory import INDEXES, Inventory
+from .records import Machine
+from .store import get_store
 import os
 
 MACHINE_BIN = os.getenv("MACHINERY_DOCKER_MACHINE_BIN", "/usr/local/bin/docker-machine")
 
+logger = logging.getLogger(__name__)
+
+# machines in any other state (starting, stopping or unknown) are about to change their state
+STABLE_STATES = ("running", "stopped", "paused", "saved", "error", "timeout")
+
 
 def get_machine_details(name, cached=False):
     """
     Get the details of a machine.
 
+    Refreshing a machine only runs docker-machine for this machine.
+
     :param name: The name of the machine
-    :param cached: Use the cache
-    :return: dict containing all machine details, None if the machine can't be found
+    :param cached: Look the machine up in the inventory, see get_inventory
+    :return: Machine, None if the machine can't be found
     """
-    machines = machines_ls(cached=cached)
-    # iter over machine_ls. If the machine is there, return it.
-    # We have to iter over machine ls because this is the only way to get the machine state.
-    if machines is not None:
-        for machine in machines:
-            if name == machine["name"]:
-                return machine
-    return None
+    if cached:
+        machine = get_inventory().get(name)
+        if machine is not None:
+            return machine
+    return refresh_machine(name)
+
+
+def refresh_machine(name):
+    """
+    Refresh a single machine and update it in the cache.
+
+    `docker-machine ls` is filtered down to the machine, so that we don't list all machines. Older versions of
+    docker-machine don't support filters, they list all machines.
+
+    :param name: The name of the machine
+    :return: Machine, None if the machine can't be found. The last known machine if docker-machine timed out
+    """
+    try:
+        rows = machine_ls_rows(filters=["name=^{0}$".format(re.escape(name))])
+        if rows is None:
+            rows = machine_ls_rows()
+    except CommandTimeout:
+        logger.exception("Refreshing machine %s timed out", name)
+        return get_inventory().get(name)
+
+    machine = None
+    for row in rows:
+        if row.name == name:
+            machine = Machine.from_ls(row)
+            break
+
+    _cache_set_machine(name, machine)
+    return machine
 
 
 def machines_ls(cached=False):
     """
     Get a detailed list of machines.
 
-    :param cached: Use the cache
+    Concurrent calls share a single run of docker-machine, and within a request the list is only built once.
+
+    :param cached: Use the cache, see last_known_machines
     :return: list of machines
     """
 
     # if cached is True, return early
     if cached:
-        return cache.get("machines_ls")
+        machines, age = last_known_machines()
+        return machines
+
+    memo = _request_memo()
+    if memo is not None and memo.get("fresh"):
+        return memo["machines"][0]
+
+    machines = _scan()
+
+    if memo is not None:
+        memo["machines"] = (machines, time.time())
+        memo["fresh"] = True
+        # the list didn't come from the cache, the inventory has to compare it
+        memo["generation"] = None
+    return machines
+
+
+def _build_machines_ls():
+    """
+    Build the list of machines from docker-machine and write it to the cache.
+
+    If docker-machine doesn't answer in time (e.g. a host hangs and ls doesn't support --timeout), the last known list
+    is kept.
+
+    :return: list of machines, the last known list (or an empty one) if docker-machine timed out
+    """
+    try:
+        rows = machine_ls_rows()
+    except CommandTimeout:
+        logger.exception("Listing the machines timed out, keeping the last known list")
+        machines, timestamp = _cache_get()
+        return machines if machines is not None else []
+
+    # docker-machine ls has everything the list needs, the inspect payload is only loaded when it's used
+    machines = [Machine.from_ls(row) for row in rows]
+
+    # write this in the cache
+    _cache_set(machines)
+    return machines
+
+
+class SingleFlight(object):
+    """
+    Wraps a function so that it runs at most once at a time. Callers that arrive while it is running wait for the
+    running call and share its result (or exception).
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self._lock = threading.Lock()
+        self._flight = None
+
+    def __call__(self):
+        with self._lock:
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["result"]
+
+        try:
+            flight["result"] = self.func()
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._flight = None
+            flight["done"].set()
+        return flight["result"]
+
+
+# the sidebar and the list are requested at the same time, let them share the same run of docker-machine
+_scan = SingleFlight(_build_machines_ls)
+
+
+# the list of machines looked up during the current request, see begin_request_memo
+_request = threading.local()
+
+
+def begin_request_memo():
+    """
+    Start memoizing the list of machines for the current thread. Called at the start of every request.
+    """
+    _request.memo = {}
+
+
+def end_request_memo():
+    """
+    Stop memoizing the list of machines for the current thread. Called at the end of every request.
+    """
+    _request.memo = None
 
-    process = subprocess.Popen([MACHINE_BIN, "ls"], stdout=subprocess.PIPE)
-    out, err = process.communicate()
+
+def _request_memo():
+    """
+    :return: dict holding the list of machines of the current request, None outside of requests
+    """
+    return getattr(_request, "memo", None)
+
+
+def last_known_machines():
+    """
+    Get the last known list of machines right away (stale-while-revalidate).
+
+    If the list is older than MACHINERY_INVENTORY_SOFT_TTL, it is still returned but a refresh is started in the
+    background. Only if there is no list at all (nothing cached yet, or older than MACHINERY_INVENTORY_HARD_TTL) the list
+    is refreshed before returning.
+
+    :return: tuple (list of machines, age of the list in seconds)
+    """
+    memo = _request_memo()
+    if memo is not None and "machines" in memo:
+        machines, timestamp = memo["machines"]
+        return machines, time.time() - timestamp
+
+    entry = _cache_get_entry()
+    if entry is None:
+        # machines_ls memoizes the list itself
+        return machines_ls(), 0
+
+    machines, timestamp = entry["machines"], entry["timestamp"]
+    age = time.time() - timestamp
+    if age > settings.MACHINERY_INVENTORY_SOFT_TTL:
+        _refresh_in_background()
+
+    if memo is not None:
+        memo["machines"] = (machines, timestamp)
+        memo["generation"] = entry.get("generation")
+    return machines, age
+
+
+# the in-memory inventory, see get_inventory
+_inventory = Inventory()
+
+
+def get_inventory():
+    """
+    Get the last known list of machines as an indexed inventory, see the inventory module.
+
+    The inventory follows the cached list of machines like last_known_machines does. Every write to the cached list gets
+    a new generation, which is also cached under a key of its own. Only that small entry is read to find out whether
+    the inventory is up to date, the list itself is only read if there is a newer generation.
+
+    :return: Inventory
+    """
+    memo = _request_memo()
+    if memo is not None and "machines" in memo:
+        # the list was read in this request already. A freshly built list has no generation, it synced the inventory
+        # when it was written
+        if memo.get("generation") is not None:
+            _inventory.sync(memo["machines"][0], memo["generation"])
+        return _inventory
+
+    state = cache.get(GENERATION_KEY)
+    if state is not None and _inventory.generation is not None and state["generation"] <= _inventory.generation:
+        if time.time() - state["timestamp"] > settings.MACHINERY_INVENTORY_SOFT_TTL:
+            _refresh_in_background()
+        return _inventory
+
+    machines, age = last_known_machines()
+    generation = memo.get("generation") if memo is not None else state and state["generation"]
+    # without a generation the list was just built, writing it synced the inventory
+    if generation is not None:
+        _inventory.sync(machines, generation)
+    return _inventory
+
+
+# filters of the inventory that docker-machine ls can filter on, and the name of its filter
+LS_FILTERS = {
+    "state": "state",
+    "driver": "driver",
+    "swarm_master": "swarm",
+}
+
+
+def find_machines(query="", **filters):
+    """
+    Find machines by name and by the secondary indexes of the inventory, see Inventory.search.
+
+    If a list of machines is known, it is searched in memory. Otherwise, instead of building the whole list first, the
+    filters are pushed down to `docker-machine ls --filter`, or to the machine store, so that only the matching
+    machines are listed. The filtered list isn't cached, it's not the list of all machines.
+
+    :param query: part of a machine name, case insensitive
+    :param filters: values of the secondary indexes, see Inventory.find
+    :return: tuple (list of machines, age of the list in seconds)
+    """
+    memo = _request_memo()
+    known = (memo is not None and "machines" in memo) or cache.get(GENERATION_KEY) is not None
+    if not known and (query or filters):
+        machines = _ls_filtered(query, filters)
+        if machines is None:
+            machines = _store_filtered(query, filters)
+        if machines is not None:
+            # docker-machine doesn't filter on everything, the rest is filtered in memory
+            return Inventory().sync(machines).search(query, **filters), 0
+
+    machines, age = last_known_machines()
+    return get_inventory().search(query, **filters), age
+
+
+def _ls_filtered(query, filters):
+    """
+    :return: list of machines that match the filters docker-machine ls supports, None if it doesn't support filters
+    """
+    arguments = []
+    if query:
+        arguments.append("name=(?i){0}".format(re.escape(query)))
+    for field, values in sorted(filters.items()):
+        if field in LS_FILTERS:
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            arguments.extend("{0}={1}".format(LS_FILTERS[field], value) for value in values)
+    if not arguments:
+        return None
+
+    try:
+        rows = machine_ls_rows(filters=arguments)
+    except CommandTimeout:
+        logger.exception("Listing the machines matching %s timed out", ", ".join(arguments))
+        return None
+    if rows is None:
+        return None
+    return [Machine.from_ls(row) for row in rows]
+
+
+def _store_filtered(query, filters):
+    """
+    Find the machines in the machine store whose config matches the query, the driver and the swarm role. Only these
+    machines are asked for their state and url, one at a time.
+
+    :return: list of machines, None if the store can't be used, the filters can't be checked on the configs or more
+             than MACHINERY_STORE_FILTER_MAX_MACHINES machines match
+    """
+    store = get_store()
+    if settings.MACHINERY_INVENTORY_BACKEND != "store" or not store.available():
+        return None
+    # agents don't know their master, see Machine.from_inspect
+    if "swarm_master" in filters or not (query or "driver" in filters or "swarm_role" in filters):
+        return None
+
+    predicates = dict((field, values if isinstance(values, (list, tuple, set)) else [values])
+                      for field, values in filters.items() if field in ("driver", "swarm_role"))
+    candidates = []
+    for name in store.names():
+        if query.lower() not in name.lower():
+            continue
+        try:
+            candidate = Machine.from_inspect(name, "unknown", store.config(name))
+        except (IOError, OSError, ValueError):
+            continue
+        if all(INDEXES[field](candidate) in values for field, values in predicates.items()):
+            candidates.append(candidate)
+            # two commands per machine, a single ls is faster for more than a handful of machines
+            if len(candidates) > settings.MACHINERY_STORE_FILTER_MAX_MACHINES:
+                return None
 
     machines = []
-    header = False
+    for candidate in candidates:
+        try:
+            state = parse_state(machine_status(candidate.name))
+            url = machine_url(candidate.name).strip() if state == "running" else ""
+        except CommandTimeout:
+            state, url = "timeout", ""
+        machines.append(Machine.from_inspect(candidate.name, state, candidate.inspect, url=url,
+                                             ip=urlparse(url).hostname or ""))
+    return machines
+
+
+# held while a background refresh is running, so that there is at most one
+_background_refresh = threading.Lock()
+
+
+def _refresh_in_background():
+    """
+    Start a thread that refreshes the list of machines, unless one is already running.
+    """
+    if not _background_refresh.acquire(False):
+        return
+
+    def refresh():
+        try:
+            with lane(BACKGROUND):
+                machines_ls()
+        finally:
+            # this thread has its own database connection for the cache, don't leak it
+            connection.close()
+            _background_refresh.release()
+
+    thread = threading.Thread(target=refresh, name="machinery-background-refresh")
+    thread.daemon = True
+    thread.start()
+
+
+def _cache_get():
+    """
+    Read the list of machines from the cache.
+
+    :return: tuple (list of machines, timestamp of the refresh), (None, None) if nothing is cached
+    """
+    entry = _cache_get_entry()
+    if entry is None:
+        return None, None
+    return entry["machines"], entry["timestamp"]
+
+
+def _cache_get_entry():
+    """
+    :return: dict with the list of machines, the timestamp of the refresh and the generation of the list. None if
+             nothing is cached
+    """
+    entry = cache.get("machines_ls")
+    # entries written by older versions are plain lists without a timestamp, or lists of dicts instead of records
+    if not isinstance(entry, dict) or not all(isinstance(machine, Machine) for machine in entry["machines"]):
+        return None
+    return entry
+
+
+# held while the cached list of machines is read and written again, so that concurrent writers don't overwrite newer
+# lists and the recorded changes match the list
+_cache_lock = threading.Lock()
+
+
+# the generation and the timestamp of the cached list, so that they can be checked without reading the list
+GENERATION_KEY = "machines_ls_generation"
+
+
+def _cache_set_list(machines, timestamp, timeout):
+    """
+    Write the list of machines and update the inventory.
+
+    Generations increase with every write (they start with the time of the write, or follow the last known generation
+    if the clock went back), so that an inventory never goes back to an older list.
+    """
+    stamp = time.time()
+    state = cache.get(GENERATION_KEY)
+    for last in (state and state["generation"], _inventory.generation):
+        if last:
+            stamp = max(stamp, last[0] + 0.001)
+    generation = (stamp, uuid.uuid4().hex)
+    cache.set("machines_ls", {"machines": machines, "timestamp": timestamp, "generation": generation}, timeout)
+    # written after the list, readers that see the new generation find the new list
+    cache.set(GENERATION_KEY, {"generation": generation, "timestamp": timestamp}, timeout)
+    _inventory.sync(machines, generation)
+
+
+def _cache_set(machines):
+    """
+    Write the list of machines to the cache. Single machines are looked up in the inventory, see get_inventory.
+    """
+    with _cache_lock:
+        previous, timestamp = _cache_get()
+        _cache_set_list(machines, time.time(), settings.MACHINERY_INVENTORY_HARD_TTL)
+        changes.record(previous, machines)
+
+
+def _cache_set_machine(name, machine):
+    """
+    Update a single machine in the cached list of machines.
+
+    :param name: name of the machine
+    :param machine: Machine, None if the machine is gone
+    """
+    _cache_set_machines({name: machine})
+
+
+def _cache_set_machines(updates):
+    """
+    Update some machines in the cached list of machines.
+
+    :param updates: dict mapping machine names to Machine, or to None if the machine is gone
+    :return: the updated list of machines, None if no list is cached
+    """
+    with _cache_lock:
+        machines, timestamp = _cache_get()
+        if machines is None:
+            return None
+
+        updated = []
+        for item in machines:
+            if item.name not in updates:
+                updated.append(item)
+            elif updates[item.name] is not None:
+                updated.append(updates[item.name])
+        known = set(item.name for item in machines)
+        updated.extend(machine for name, machine in sorted(updates.items())
+                       if machine is not None and name not in known)
+
+        # the list keeps its age, only these machines are fresh
+        timeout = int(settings.MACHINERY_INVENTORY_HARD_TTL - (time.time() - timestamp))
+        if timeout > 0:
+            _cache_set_list(updated, timestamp, timeout)
+            changes.record(machines, updated)
+        return updated
+
+
+def refresh_machines(names):
+    """
+    Refresh the cached list of machines after some machines changed.
+
+    If docker-machine supports filters, `docker-machine ls` only lists the machines in names and they are updated in the
+    cached list. Otherwise it runs once to get all machines. The machine store is told to forget the machines in names,
+    so that their inspect payload is read again.
+
+    :param names: iterable of machine names that changed
+    :return: list of machines
+    """
+    names = sorted(set(names))
+    store = get_store()
+    for name in names:
+        store.forget(name)
+
+    if names and _cache_get_entry() is not None:
+        try:
+            rows = machine_ls_rows(filters=["name=^({0})$".format("|".join(re.escape(name) for name in names))])
+        except CommandTimeout:
+            logger.exception("Listing the machines %s timed out, keeping the last known list", ", ".join(names))
+            return _cache_get()[0] or []
+        if rows is not None:
+            found = dict((row.name, Machine.from_ls(row)) for row in rows if row.name in names)
+            machines = _cache_set_machines(dict((name, found.get(name)) for name in names))
+            if machines is not None:
+                return machines
+
+    # don't join a scan that is already running, it might have started before the machines changed
+    return _build_machines_ls()
+
+
+def transitional_machines(machines):
+    """
+    Get the machines that are in a transitional or unknown state.
+
+    :param machines: list of machines
+    :return: list of machine names
+    """
+    return [machine.name for machine in machines if machine.state not in STABLE_STATES]
+
+
+# a row of `docker-machine ls`
+LsRow = namedtuple("LsRow", ["name", "active", "driver", "state", "url", "swarm"])
+
+# the columns of LsRow, as a template for `docker-machine ls --format`
+LS_FORMAT = "\t".join(["{{.Name}}", "{{.Active}}", "{{.DriverName}}", "{{.State}}", "{{.URL}}", "{{.Swarm}}"])
+
+def machine_ls_rows(filters=None):
+    """
+    Get every machine from `docker-machine ls`.
+
+    Versions of docker-machine that support `--format` print the columns we ask for, older versions print a table
+    that is parsed by its header. If supported, `--timeout` makes docker-machine give up on a machine after
+    MACHINERY_COMMAND_TIMEOUT, instead of running into MACHINERY_LS_TIMEOUT for the whole list.
+
+    :param filters: list of filters passed to `docker-machine ls --filter`, e.g. ["driver=virtualbox"]
+    :return: list of LsRow, None if docker-machine doesn't support the filters
+    """
+    capabilities = get_capabilities(MACHINE_BIN)
+    if filters and not capabilities.ls_filter:
+        return None
+
+    command = [MACHINE_BIN, "ls"]
+    if capabilities.ls_timeout:
+        command.extend(["--timeout", str(max(1, int(settings.MACHINERY_COMMAND_TIMEOUT)))])
+    for item in filters or []:
+        command.extend(["--filter", item])
+    if capabilities.ls_format:
+        command.extend(["--format", LS_FORMAT])
+
+    returncode, out, err = execute(command, timeout=settings.MACHINERY_LS_TIMEOUT)
+    if returncode != 0 and filters:
+        return None
+
+    return parse_ls_format(out) if capabilities.ls_format else parse_ls_table(out)
+
+
+def parse_ls_format(out):
+    """
+    Parse the output of `docker-machine ls --format LS_FORMAT`.
+
+    :param out: str
+    :return: list of LsRow
+    """
+    rows = []
+    for line in out.splitlines():
+        values = line.split("\t")
+        if len(values) != len(LsRow._fields) or not values[0]:
+            continue
+        name, active, driver, state, url, swarm = [value.strip() for value in values]
+        rows.append(LsRow(name, active == "*", driver or None, parse_state(state), url, swarm))
+    return rows
+
+
+def parse_ls_table(out):
+    """
+    Parse the table printed by `docker-machine ls`.
+
+    The columns are aligned, every value starts at the position of its column name in the header. Columns can be
+    empty (e.g. ACTIVE and SWARM), newer versions of docker-machine add more columns.
+
+    :param out: str
+    :return: list of LsRow
+    """
+    rows = []
+    columns = None
 
-    #
     for line in out.splitlines():
 
-        # machine ls can yield some errors at the beginning. Mark the table header so that we don't accidentially
+        # machine ls can yield some errors at the beginning. Wait for the table header so that we don't accidentially
         # parse error messages as machines
-        if line.startswith("NAME"):
-            header = True
+        if columns is None:
+            if line.startswith("NAME"):
+                columns = [(match.group(0), match.start()) for match in re.finditer(r"\S+", line)]
             continue
 
-        if header:
-            # parse the machine
-            data = line.split()
-            name = data[0]
-            line = line.replace(name, "")
-
-            # as of docker-machine 0.2 there is no way to get the machines state using the CLI. We have to parse
-            # it from the table
-            if "Running" in line:
-                state = "running"
-            elif "Stopped" in line:
-                state = "stopped"
-            else:
-                state = "unknown"
-
-            # add some more details
-            inspect = machine_inspect(name)
-
-            machines.append({
-                "name": name,
-                "state": state,
-                "inspect": inspect,
-                "driver_class": driver_class_by_name(inspect.get("DriverName", None)),
-                "ip": machine_ip(name),
-                "url": machine_url(name)}
-            )
+        if not line.strip():
+            continue
 
-    # write this in the cache
-    cache.set("machines_ls", machines, 60*5)
-    return machines
+        values = {}
+        for i, (column, start) in enumerate(columns):
+            end = columns[i + 1][1] if i + 1 < len(columns) else None
+            values[column] = line[start:end].strip()
+
+        rows.append(LsRow(
+            name=line.split()[0],
+            active=values.get("ACTIVE") == "*",
+            driver=values.get("DRIVER") or None,
+            state=parse_state(values.get("STATE")),
+            url=values.get("URL", ""),
+            swarm=values.get("SWARM", ""),
+        ))
+
+    return rows
+
+
+def parse_state(state):
+    """
+    :param state: state as printed by docker-machine ls, e.g. "Running"
+    :return: lower case state, "unknown" if there is none
+    """
+    return state.lower() if state else "unknown"
+
+
+def get_inspect(name):
+    """
+    Inspect a machine using the configured inventory backend.
+
+    The store backend reads the config of the machine from disk. If that fails, or if the CLI backend is configured,
+    `docker-machine inspect` is used.
+
+    :param name: name of the machine
+    :return: dict
+    """
+    if settings.MACHINERY_INVENTORY_BACKEND == "store":
+        store = get_store()
+        if store.available():
+            try:
+                return store.config(name)
+            except (IOError, OSError, ValueError):
+                # the machine is not (or not yet) in the store, ask the CLI
+                pass
+
+    return machine_inspect(name)
+
+
+def get_inspect_many(names):
+    """
+    Inspect several machines using the configured inventory backend, see get_inspect.
+
+    Machines that aren't in the store are inspected with a single `docker-machine inspect` if the binary supports
+    more than one name, one at a time otherwise.
+
+    :param names: list of machine names
+    :return: dict mapping the names to their inspect payload. Machines that couldn't be inspected are left out
+    """
+    inspects = {}
+    missing = []
+    store = get_store()
+    if settings.MACHINERY_INVENTORY_BACKEND == "store" and store.available():
+        for name in names:
+            try:
+                inspects[name] = store.config(name)
+            except (IOError, OSError, ValueError):
+                missing.append(name)
+    else:
+        missing = list(names)
+
+    if len(missing) > 1 and get_capabilities(MACHINE_BIN).inspect_many:
+        batch = machine_inspect_many(missing)
+        inspects.update(batch)
+        missing = [name for name in missing if name not in batch]
+
+    for name in missing:
+        try:
+            inspects[name] = machine_inspect(name)
+        except (CommandTimeout, CommandFailed, ValueError):
+            pass
+
+    return inspects
 
 
 def machine_inspect(name):
     """
     Inspect a machine
 
+    Raises CommandFailed if docker-machine can't inspect the machine, e.g. because it was removed.
+
     :param name: name of the machine
     :return: dict
     """
-    process = subprocess.Popen([MACHINE_BIN, "inspect", name], stdout=subprocess.PIPE)
-    out, err = process.communicate()
+    command = [MACHINE_BIN, "inspect", name]
+    returncode, out, err = execute(command, timeout=settings.MACHINERY_COMMAND_TIMEOUT)
+    if returncode != 0:
+        raise CommandFailed(command, returncode, err)
 
     return json.loads(out)
 
 
+def machine_inspect_many(names):
+    """
+    Inspect several machines with a single command, only supported by newer versions of docker-machine.
+
+    :param names: list of machine names
+    :return: dict mapping the names to their inspect payload, empty if the output can't be matched to the names
+    """
+    try:
+        returncode, out, err = execute([MACHINE_BIN, "inspect"] + list(names),
+                                       timeout=settings.MACHINERY_COMMAND_TIMEOUT * len(names))
+    except CommandTimeout:
+        return {}
+
+    # depending on the version the documents are printed one after the other or as a list
+    decoder = json.JSONDecoder()
+    documents = []
+    out = out.strip()
+    try:
+        while out:
+            document, end = decoder.raw_decode(out)
+            documents.extend(document if isinstance(document, list) else [document])
+            out = out[end:].strip()
+    except ValueError:
+        return {}
+
+    if len(documents) != len(names) or not all(isinstance(document, dict) for document in documents):
+        # e.g. a machine doesn't exist, callers inspect the machines one at a time
+        return {}
+    inspects = dict((document.get("Name", name), document) for name, document in zip(names, documents))
+    return inspects if set(inspects) == set(names) else {}
+
+
 def machine_ip(name):
     """
     Get the IP for a machine
@@ -113,12 +757,23 @@ def machine_ip(name):
     :param name: name of the machine
     :return: ip address string
     """
-    process = subprocess.Popen([MACHINE_BIN, "ip", name], stdout=subprocess.PIPE)
-    out, err = process.communicate()
+    returncode, out, err = execute([MACHINE_BIN, "ip", name], timeout=settings.MACHINERY_COMMAND_TIMEOUT)
 
     return out
 
 
+def machine_status(name):
+    """
+    Get the state of a machine
+
+    :param name: name of the machine
+    :return: state string, e.g. "Running"
+    """
+    returncode, out, err = execute([MACHINE_BIN, "status", name], timeout=settings.MACHINERY_COMMAND_TIMEOUT)
+
+    return out.strip()
+
+
 def machine_url(name):
     """
     Get the URL for a machine
@@ -126,8 +781,7 @@ def machine_url(name):
     :param name: name of the machine
     :return: url string
     """
-    process = subprocess.Popen([MACHINE_BIN, "url", name], stdout=subprocess.PIPE)
-    out, err = process.communicate()
+    returncode, out, err = execute([MACHINE_BIN, "url", name], timeout=settings.MACHINERY_COMMAND_TIMEOUT)
 
     return out
 
@@ -144,25 +798,37 @@ def machine_rm(name, force=False):
     if force:
         command.append("-f")
 
-    process = subprocess.Popen(command, stdout=subprocess.PIPE)
-    out, err = process.communicate()
-    process.wait()
-    return process.returncode == 0, out
+    try:
+        returncode, out, err = execute(command, timeout=settings.MACHINERY_RM_TIMEOUT)
+    except CommandTimeout as e:
+        return False, str(e)
+    return returncode == 0, out
 
 
-def run(command):
+def run(command, timeout=None):
     """
     Runs a command using subprocess.Popen. Yields the output from stdout.
 
+    If the command is still running after timeout seconds, it is killed together with all of its children.
 
     :param command: list or string
+    :param timeout: seconds the command may take, defaults to MACHINERY_RUN_TIMEOUT
     """
 
     print("running", command)
 
-    process = subprocess.Popen(command, stdout=subprocess.PIPE)
-    for line in iter(process.stdout.readline, ''):
-        yield line
+    if timeout is None:
+        timeout = settings.MACHINERY_RUN_TIMEOUT
+
+    process = spawn(command, stdout=subprocess.PIPE)
+    watchdog = Watchdog(process, timeout)
+    try:
+        for line in iter(process.stdout.readline, b''):
+            yield line
+        process.wait()
+    finally:
+        watchdog.cancel()
 
-    process.wait()
+    if watchdog.fired:
+        yield "{0}\n".format(CommandTimeout(command, timeout))
     yield process.returncode
\ No newline at end of file
@@ -0,0 +1,265 @@
+"""
+This module runs docker-machine commands.
+
+All commands go through a single executor with a fixed number of worker threads, which limits the number of
+docker-machine processes running at the same time. Commands are queued in two lanes: interactive commands (issued while
+handling a request) always run before background commands (issued by the refresher, the store watcher, ...).
+
+Commands can have a deadline. If a command is still running when its deadline passes, its whole process group is killed
+(docker-machine starts ssh and driver plugin processes of its own) and CommandTimeout is raised.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import itertools
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+
+try:
+    from Queue import PriorityQueue
+except ImportError:
+    from queue import PriorityQueue
+
+# lanes, lower values run first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_context = threading.local()
+
+
+class CommandTimeout(Exception):
+    """
+    Raised if a command didn't finish before its deadline.
+    """
+
+    def __init__(self, command, timeout):
+        super(CommandTimeout, self).__init__("{0} timed out after {1} seconds".format(" ".join(command), timeout))
+        self.command = command
+        self.timeout = timeout
+
+
+class CommandFailed(Exception):
+    """
+    Raised if a command exited with an error.
+    """
+
+    def __init__(self, command, returncode, err):
+        super(CommandFailed, self).__init__("{0} failed with {1}: {2}".format(" ".join(command), returncode,
+                                                                             err.strip()))
+        self.command = command
+        self.returncode = returncode
+        self.err = err
+
+
+def spawn(command, **kwargs):
+    """
+    Start a command in a process group of its own, so that it can be killed with all of its children.
+
+    :param command: list
+    :return: subprocess.Popen
+    """
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["preexec_fn"] = os.setsid
+    return subprocess.Popen(command, **kwargs)
+
+
+def kill(process):
+    """
+    Kill a process started with spawn and all of its children.
+
+    :param process: subprocess.Popen
+    """
+    try:
+        if os.name == "nt":
+            subprocess.call(["taskkill", "/F", "/T", "/PID", str(process.pid)])
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # the process is already gone
+        pass
+
+
+class Watchdog(object):
+    """
+    Kills a process started with spawn after timeout seconds. Cancel it once the process finished.
+    """
+
+    def __init__(self, process, timeout):
+        self.fired = False
+        self._timer = threading.Timer(timeout, self._fire, [process])
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _fire(self, process):
+        self.fired = True
+        kill(process)
+
+    def cancel(self):
+        self._timer.cancel()
+
+
+def current_lane():
+    """
+    Get the lane commands of the current thread are queued in. Defaults to INTERACTIVE.
+    """
+    return getattr(_context, "lane", INTERACTIVE)
+
+
+@contextmanager
+def lane(value):
+    """
+    Context manager that queues all commands of the current thread in the given lane.
+
+    :param value: INTERACTIVE or BACKGROUND
+    """
+    previous = current_lane()
+    _context.lane = value
+    try:
+        yield
+    finally:
+        _context.lane = previous
+
+
+class CommandFuture(object):
+    """
+    The pending result of a command.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def result(self):
+        """
+        Wait for the command to finish.
+
+        :return: tuple (returncode, stdout, stderr)
+        """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class CommandExecutor(object):
+    """
+    Runs commands on a fixed number of worker threads.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = PriorityQueue()
+        # keeps commands in the same lane in order
+        self._counter = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="machinery-executor-%d" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, command, lane=None, timeout=None):
+        """
+        Queue a command.
+
+        :param command: list
+        :param lane: INTERACTIVE or BACKGROUND, defaults to the lane of the current thread
+        :param timeout: seconds the command may take, including the time it waits in the queue. None for no limit
+        :return: CommandFuture
+        """
+        if len(self._threads) < self.workers:
+            self._start()
+
+        future = CommandFuture()
+        deadline = time.time() + timeout if timeout is not None else None
+        self._queue.put((current_lane() if lane is None else lane, next(self._counter), command, timeout, deadline,
+                         future))
+        return future
+
+    def execute(self, command, lane=None, timeout=None):
+        """
+        Run a command and wait for it to finish.
+
+        :param command: list
+        :param lane: INTERACTIVE or BACKGROUND, defaults to the lane of the current thread
+        :param timeout: seconds the command may take, None for no limit
+        :return: tuple (returncode, stdout, stderr)
+        """
+        return self.submit(command, lane=lane, timeout=timeout).result()
+
+    def _work(self):
+        while True:
+            _, _, command, timeout, deadline, future = self._queue.get()
+            try:
+                future.set_result(self._run(command, timeout, deadline))
+            except Exception as e:
+                future.set_error(e)
+
+    def _run(self, command, timeout, deadline):
+        if deadline is None:
+            process = spawn(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = process.communicate()
+            return process.returncode, out, err
+
+        remaining = deadline - time.time()
+        # the deadline passed while the command was queued, don't bother starting it
+        if remaining <= 0:
+            raise CommandTimeout(command, timeout)
+
+        process = spawn(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        watchdog = Watchdog(process, remaining)
+        try:
+            out, err = process.communicate()
+        finally:
+            watchdog.cancel()
+
+        if watchdog.fired:
+            raise CommandTimeout(command, timeout)
+        return process.returncode, out, err
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Get the executor all docker-machine commands run on.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = CommandExecutor(settings.MACHINERY_COMMAND_WORKERS)
+    return _executor
+
+
+def execute(command, lane=None, timeout=None):
+    """
+    Run a command on the executor and wait for it to finish.
+
+    :param command: list
+    :param lane: INTERACTIVE or BACKGROUND, defaults to the lane of the current thread
+    :param timeout: seconds the command may take, None for no limit
+    :return: tuple (returncode, stdout, stderr)
+    """
+    return get_executor().execute(command, lane=lane, timeout=timeout)
@@ -3,7 +3,7 @@ from __future__ import absolute_import, print_function, unicode_literals
 from django import forms
 from .models import Job
 from crispy_forms.helper import FormHelper
-from .core import machines_ls
+from .core import get_inventory
 
 
 class JobForm(forms.Form):
@@ -31,11 +31,8 @@ class MachineForm(forms.Form):
         checks if a machine with this name already exists and raises an ValidationError if this is the case
         """
         name = self.cleaned_data["name"]
-        machines = machines_ls(cached=True)
-        if machines is not None:
-            for machine in machines:
-                if machine["name"] == name:
-                    raise forms.ValidationError("A machine with the name {0} already exists".format(name))
+        if name in get_inventory():
+            raise forms.ValidationError("A machine with the name {0} already exists".format(name))
         return name
 
 
@@ -0,0 +1,168 @@
+"""
+This module implements an indexed, in-memory view of the list of machines.
+
+The inventory follows the cached list of machines (see core.get_inventory). Machines are indexed by name and by
+state, driver, swarm role and swarm master, so that a lookup by name takes constant time and a filtered lookup only
+touches the matching machines. When the list changes, only the machines that were added, removed or changed are
+indexed again.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import threading
+from collections import defaultdict
+
+
+# secondary indexes and how to get the indexed value of a machine
+INDEXES = {
+    "state": lambda machine: machine.state,
+    "driver": lambda machine: machine.driver,
+    "swarm_role": lambda machine: machine.swarm_role,
+    "swarm_master": lambda machine: machine.swarm_master,
+}
+
+
+class Inventory(object):
+    """
+    Indexed list of machines.
+
+    All methods are thread safe. Lookups return the machines in the order of the list of machines.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # the generation of the cached list the inventory was last synced with
+        self.generation = None
+        self._machines = {}
+        self._positions = {}
+        self._order = []
+        self._indexes = dict((field, defaultdict(set)) for field in INDEXES)
+
+    def sync(self, machines, generation=None):
+        """
+        Bring the inventory up to date with a list of machines.
+
+        If the generation isn't newer than the one of the last sync, nothing is done, so a list that was read before a
+        newer list was written never replaces it. Otherwise only the machines that were added, removed or changed are
+        indexed again.
+
+        :param machines: list of machines
+        :param generation: token of the list, increases whenever the list is written. None if it isn't known
+        :return: the inventory
+        """
+        with self._lock:
+            if generation is not None and self.generation is not None and generation <= self.generation:
+                return self
+
+            current = dict((machine.name, machine) for machine in machines)
+            for name in [name for name in self._machines if name not in current]:
+                self._unindex(name)
+            for name, machine in current.items():
+                if self._machines.get(name) != machine:
+                    self._unindex(name)
+                    self._index(machine)
+
+            self._order = [machine.name for machine in machines]
+            self._positions = dict((name, position) for position, name in enumerate(self._order))
+            self.generation = generation
+        return self
+
+    def _index(self, machine):
+        name = machine.name
+        # the inventory lives as long as the process, it doesn't keep the inspect payloads around
+        self._machines[name] = machine.compact()
+        for field, value in INDEXES.items():
+            self._indexes[field][value(machine)].add(name)
+
+    def _unindex(self, name):
+        machine = self._machines.pop(name, None)
+        if machine is None:
+            return
+        for field, value in INDEXES.items():
+            index = self._indexes[field]
+            key = value(machine)
+            index[key].discard(name)
+            if not index[key]:
+                del index[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._order)
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._machines
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        """
+        :return: list of all machines
+        """
+        with self._lock:
+            return [self._machines[name] for name in self._order]
+
+    def get(self, name):
+        """
+        :param name: name of the machine
+        :return: Machine, None if there is no such machine
+        """
+        with self._lock:
+            return self._machines.get(name)
+
+    def values(self, field):
+        """
+        :param field: name of a secondary index
+        :return: dict mapping the indexed values to the number of machines
+        """
+        with self._lock:
+            return dict((key, len(names)) for key, names in self._indexes[field].items())
+
+    def find(self, **filters):
+        """
+        Look up machines by their secondary indexes, e.g. find(state="running", driver=["virtualbox", "vmwarefusion"]).
+
+        Every filter is a value or a list of values. A machine matches if it matches one of the values of every filter.
+
+        :return: list of machines
+        """
+        with self._lock:
+            names = None
+            for field, values in filters.items():
+                if field not in INDEXES:
+                    raise KeyError("there is no index for {0}".format(field))
+                if not isinstance(values, (list, tuple, set)):
+                    values = [values]
+                matches = set()
+                for value in values:
+                    matches.update(self._indexes[field].get(value, ()))
+                names = matches if names is None else names & matches
+                if not names:
+                    return []
+
+            if names is None:
+                names = self._order
+            else:
+                names = sorted(names, key=self._positions.get)
+            return [self._machines[name] for name in names]
+
+    def search(self, query, **filters):
+        """
+        Find machines whose name contains the query, narrowed down by the secondary indexes first. Exact matches come
+        first, then machines whose name starts with the query, then all others.
+
+        :param query: part of a machine name, case insensitive
+        :return: list of machines
+        """
+        query = query.lower()
+        if not query:
+            return self.find(**filters)
+
+        def rank(machine):
+            name = machine.name.lower()
+            return 0 if name == query else 1 if name.startswith(query) else 2
+
+        machines = [machine for machine in self.find(**filters) if query in machine.name.lower()]
+        # sorting is stable, machines with the same rank stay in the order of the list
+        return sorted(machines, key=rank)
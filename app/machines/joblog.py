@@ -0,0 +1,168 @@
+"""
+This module stores the output of jobs.
+
+Every job has an append-only log file in MACHINERY_JOB_LOG_ROOT. Output is buffered and appended in batches, so that a
+chatty command doesn't cause a write for every line it prints.
+
+Readers that follow a log (e.g. the job stream) don't have to poll: whenever output is appended or a job finishes, they
+are woken up through wait_for_change.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import threading
+import time
+from django.conf import settings
+
+# notified whenever a log is appended to or a job finishes
+_changed = threading.Condition()
+_version = [0]
+# pk -> success of the jobs that finished while this process is running
+_finished = {}
+
+
+def _notify():
+    with _changed:
+        _version[0] += 1
+        _changed.notify_all()
+
+
+def change_version():
+    """
+    :return: int, pass it to wait_for_change
+    """
+    with _changed:
+        return _version[0]
+
+
+def wait_for_change(version, timeout):
+    """
+    Wait until a log is appended to or a job finishes.
+
+    :param version: the version returned by change_version (or wait_for_change) before the caller read the logs
+    :param timeout: seconds to wait at most
+    :return: tuple (the new version, True if anything changed)
+    """
+    with _changed:
+        if _version[0] == version:
+            _changed.wait(timeout)
+        return _version[0], _version[0] != version
+
+
+def notify_finished(pk, success):
+    """
+    Record that a job finished and wake up its readers.
+
+    :param pk: pk of the job
+    :param success: bool
+    """
+    with _changed:
+        _finished[pk] = success
+    _notify()
+
+
+def finished_status(pk):
+    """
+    Get the status of a job that finished while this process is running.
+
+    :param pk: pk of the job
+    :return: tuple (finished, success)
+    """
+    with _changed:
+        if pk in _finished:
+            return True, _finished[pk]
+    return False, None
+
+
+class JobLog(object):
+    """
+    Append-only log of a job.
+
+    Buffered output is flushed once `flush_size` bytes are buffered, or at the latest `flush_interval` seconds after it
+    was written. Use the log as a context manager while writing to make sure everything is flushed in the end.
+    """
+
+    def __init__(self, pk, flush_size=None, flush_interval=None):
+        self.path = os.path.join(settings.MACHINERY_JOB_LOG_ROOT, "{0}.log".format(pk))
+        self.flush_size = flush_size if flush_size is not None else settings.MACHINERY_JOB_LOG_FLUSH_SIZE
+        self.flush_interval = (flush_interval if flush_interval is not None
+                               else settings.MACHINERY_JOB_LOG_FLUSH_INTERVAL)
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def write(self, data):
+        """
+        Append data to the log.
+
+        :param data: bytes or unicode
+        """
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+
+        with self._lock:
+            self._buffer.append(data)
+            self._buffered += len(data)
+
+            if self._buffered >= self.flush_size or time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+            elif self._timer is None:
+                # make sure the data shows up even if the command doesn't print anything for a while
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Append all buffered data to the log file.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._buffer:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with open(self.path, "ab") as f:
+                f.write(b"".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+            _notify()
+
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+    def read(self, offset=0):
+        """
+        Read the log.
+
+        :param offset: byte offset to start reading at
+        :return: tuple (bytes, offset of the end of the log)
+        """
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except IOError:
+            return b"", offset
+        return data, offset + len(data)
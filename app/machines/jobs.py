@@ -0,0 +1,106 @@
+"""
+This module runs jobs in the background.
+
+Creating a machine can take minutes. Instead of running jobs while handling the request that launches them, jobs are
+queued and run on a fixed number of worker threads. Their progress is read from the Job model.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+import threading
+from django.conf import settings
+from django.db import connection
+from .joblog import notify_finished
+from .models import Job
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class JobExecutor(object):
+    """
+    Runs jobs on a fixed number of worker threads.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="machinery-jobs-%d" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, job):
+        """
+        Queue a job. A job is only queued once, no matter how often this is called.
+
+        :param job: Job
+        :return: True if the job was queued, False if it was queued before
+        """
+        # mark the job as started in a single query, so that two requests can't both queue it
+        if not Job.objects.filter(pk=job.pk, started=False).update(started=True):
+            return False
+
+        if len(self._threads) < self.workers:
+            self._start()
+
+        self._queue.put(job.pk)
+        return True
+
+    def _work(self):
+        while True:
+            pk = self._queue.get()
+            try:
+                self._run(pk)
+            finally:
+                # don't keep a database connection open while waiting for the next job
+                connection.close()
+
+    def _run(self, pk):
+        """
+        Run a job. If it fails before it finished, it's marked as failed.
+
+        :param pk: pk of the job
+        """
+        try:
+            Job.objects.get(pk=pk).run()
+        except Exception:
+            logger.exception("Job %s failed", pk)
+            # a job that finished keeps its result
+            if Job.objects.filter(pk=pk, finished=False).update(finished=True, success=False):
+                notify_finished(pk, False)
+
+
+def fail_interrupted_jobs():
+    """
+    Mark jobs as failed that were running when the process stopped. They never finish and can't be queued again.
+
+    :return: number of jobs marked as failed
+    """
+    return Job.objects.filter(started=True, finished=False).update(finished=True, success=False)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_job_executor():
+    """
+    Get the executor all jobs run on.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = JobExecutor(settings.MACHINERY_JOB_WORKERS)
+    return _executor
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from .core import begin_request_memo, end_request_memo
+
+
+class MachinesMemoMiddleware(object):
+    """
+    Middleware that memoizes the list of machines for the duration of a request, so that the view, its forms and the
+    context processors share a single lookup.
+    """
+
+    def process_request(self, request):
+        begin_request_memo()
+
+    def process_response(self, request, response):
+        end_request_memo()
+        return response
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started', models.BooleanField(default=False)),
+                ('name', models.CharField(max_length=40)),
+                ('params', jsonfield.fields.JSONField()),
+                ('legacy_output', models.TextField(db_column='output')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SwarmToken',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('token', models.CharField(max_length=100)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machines', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='finished',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='success',
+            field=models.NullBooleanField(),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='legacy_output',
+            field=models.TextField(default='', db_column='output', blank=True),
+        ),
+    ]
@@ -1,21 +1,43 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+import logging
 import os
 from django.db import models
 from .core import run, machines_ls
+from .joblog import JobLog, notify_finished
 from jsonfield import JSONField
 
 MACHINE_BIN = os.getenv("MACHINERY_DOCKER_MACHINE_BIN", "/usr/local/bin/docker-machine")
 
+logger = logging.getLogger(__name__)
+
 class Job(models.Model):
     """
     Model that holds information about a job.
     """
 
     started = models.BooleanField(default=False)
+    finished = models.BooleanField(default=False)
+    success = models.NullBooleanField()
     name = models.CharField(max_length=40)
     params = JSONField()
-    output = models.TextField()
+    # jobs used to store their output here, it's in the log now. See the output property
+    legacy_output = models.TextField(db_column="output", blank=True, default="")
+
+    @property
+    def log(self):
+        return JobLog(self.pk)
+
+    @property
+    def output(self):
+        """
+        The output of the job, read from its log.
+        """
+        log = self.log
+        if not log.exists():
+            return self.legacy_output
+        data, offset = log.read()
+        return data.decode("utf-8", "replace")
 
     @property
     def command(self):
@@ -71,18 +93,26 @@ class Job(models.Model):
 
         returncode = None
 
-        for item in run(self.format_command()):
-            if isinstance(item, int):
-                returncode = item
-                break
+        with self.log as log:
+            for item in run(self.format_command()):
+                if isinstance(item, int):
+                    returncode = item
+                    break
+
+                log.write(item)
 
-            self.output += item
-            self.save()
+        self.finished = True
+        self.success = returncode == 0
+        self.save()
+        notify_finished(self.pk, self.success)
 
-        # run machines ls to update the cache
-        machines_ls()
+        # run machines ls to update the cache. The job is done, failing to refresh the cache doesn't make it fail
+        try:
+            machines_ls()
+        except Exception:
+            logger.exception("Refreshing the machine cache after job %s failed", self.pk)
 
-        return returncode == 0
+        return self.success
 
 
 class SwarmToken(models.Model):
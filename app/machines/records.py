@@ -0,0 +1,136 @@
+"""
+This module implements the record that stands for a single machine in the list of machines.
+
+A record only holds what the list views, the inventory indexes and the API need, all of it is printed by
+`docker-machine ls`. The raw inspect payload can be large, it is never pickled into the cache. It is loaded from the
+machine store (or the CLI) when it is accessed.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from django.utils.six.moves.urllib.parse import urlparse
+from drivers.models import driver_class_by_name
+
+
+class Machine(object):
+    """
+    A machine, as listed by machines_ls.
+    """
+
+    __slots__ = ("name", "state", "driver", "ip", "url", "swarm_role", "swarm_master", "_inspect")
+
+    # the fields that are stored in the cache and compared
+    FIELDS = ("name", "state", "driver", "ip", "url", "swarm_role", "swarm_master")
+
+    def __init__(self, name, state, driver=None, ip="", url="", swarm_role=None, swarm_master=None, inspect=None):
+        self.name = name
+        self.state = state
+        self.driver = driver
+        self.ip = ip
+        self.url = url
+        self.swarm_role = swarm_role
+        self.swarm_master = swarm_master
+        self._inspect = inspect
+
+    @classmethod
+    def from_ls(cls, row):
+        """
+        Build a machine from a row of `docker-machine ls`. The inspect payload is loaded when it's accessed.
+
+        :param row: LsRow
+        :return: Machine
+        """
+        # the swarm column holds the name of the master, followed by "(master)" on the master itself
+        master, _, role = row.swarm.partition(" ")
+        if not master:
+            role = None
+        elif role == "(master)":
+            role = "master"
+        else:
+            role = "agent"
+
+        return cls(row.name, row.state, driver=row.driver, ip=urlparse(row.url).hostname or "", url=row.url,
+                   swarm_role=role, swarm_master=master or None)
+
+    @classmethod
+    def from_inspect(cls, name, state, inspect, ip="", url=""):
+        """
+        Build a machine from its inspect payload.
+
+        :param name: name of the machine
+        :param state: state of the machine
+        :param inspect: dict, the output of machine_inspect
+        :param ip: ip address string
+        :param url: url string
+        :return: Machine
+        """
+        swarm = (inspect.get("HostOptions") or {}).get("SwarmOptions") or {}
+        # agents don't know the name of their master
+        if swarm.get("Master"):
+            role, master = "master", name
+        elif swarm.get("IsSwarm"):
+            role, master = "agent", None
+        else:
+            role, master = None, None
+
+        return cls(name, state, driver=inspect.get("DriverName"), ip=ip, url=url, swarm_role=role, swarm_master=master,
+                   inspect=inspect)
+
+    @property
+    def inspect(self):
+        """
+        The raw inspect payload. Unless the record was built with it (see with_inspect), it is loaded on every access, so
+        that it never outlives the record in memory.
+
+        :return: dict, empty if docker-machine didn't answer in time or can't inspect the machine (e.g. because it was
+                 removed)
+        """
+        if self._inspect is not None:
+            return self._inspect
+        # machines that timed out don't have any details
+        if self.state == "timeout":
+            return {}
+
+        from .core import get_inspect
+        from .executor import CommandFailed, CommandTimeout
+        try:
+            return get_inspect(self.name)
+        except (CommandTimeout, CommandFailed, ValueError):
+            return {}
+
+    def with_inspect(self):
+        """
+        :return: a copy of the machine that keeps its inspect payload, for callers that use it more than once
+        """
+        return Machine(*self.__getstate__(), inspect=self.inspect)
+
+    def compact(self):
+        """
+        :return: a copy of the machine without the inspect payload, like it is read from the cache
+        """
+        machine = Machine.__new__(Machine)
+        machine.__setstate__(self.__getstate__())
+        return machine
+
+    @property
+    def driver_class(self):
+        return driver_class_by_name(self.driver)
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.FIELDS, state):
+            setattr(self, field, value)
+        self._inspect = None
+
+    def __eq__(self, other):
+        return isinstance(other, Machine) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<Machine {0} ({1})>".format(self.name, self.state)
@@ -0,0 +1,54 @@
+"""
+This module keeps the cached list of machines warm.
+
+The refresher rebuilds the list of machines every `interval` seconds. Machines that are in a transitional or unknown
+state (e.g. starting, stopping or unreachable) are refreshed every `transitional_interval` seconds, so that their final
+state shows up quickly.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+import threading
+import time
+from .core import machines_ls, refresh_machines, transitional_machines
+from .executor import BACKGROUND, lane
+
+logger = logging.getLogger(__name__)
+
+
+class InventoryRefresher(threading.Thread):
+    """
+    Thread that refreshes the cached list of machines on a schedule.
+    """
+
+    def __init__(self, interval=60.0, transitional_interval=5.0):
+        super(InventoryRefresher, self).__init__(name="machinery-inventory-refresher")
+        self.daemon = True
+        self.interval = interval
+        self.transitional_interval = transitional_interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        with lane(BACKGROUND):
+            self._refresh()
+
+    def _refresh(self):
+        last_full_refresh = None
+
+        while not self._stopped.is_set():
+            try:
+                if last_full_refresh is None or time.time() - last_full_refresh >= self.interval:
+                    machines_ls()
+                    last_full_refresh = time.time()
+                else:
+                    names = transitional_machines(machines_ls(cached=True) or [])
+                    if names:
+                        refresh_machines(names)
+            except Exception:
+                logger.exception("Refreshing the list of machines failed")
+
+            self._stopped.wait(self.transitional_interval)
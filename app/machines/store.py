@@ -0,0 +1,93 @@
+"""
+This module reads the machine store of docker-machine from disk.
+
+docker-machine persists every machine in `<MACHINE_STORAGE_PATH>/machines/<name>/config.json`. The file holds the same
+document `docker-machine inspect` prints, so reading it directly saves a process per machine.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import json
+import os
+import threading
+from django.conf import settings
+
+
+class MachineStore(object):
+    """
+    Reads machine configs from a docker-machine storage path.
+
+    Parsed configs are cached and keyed on the mtime of the config file, so unchanged machines are never parsed twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._configs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def machines_path(self):
+        return os.path.join(self.path, "machines")
+
+    def available(self):
+        """
+        Checks if the storage path exists.
+        """
+        return os.path.isdir(self.machines_path)
+
+    def config_path(self, name):
+        return os.path.join(self.machines_path, name, "config.json")
+
+    def names(self):
+        """
+        Get the names of all machines in the store, sorted like `docker-machine ls` sorts them.
+
+        :return: list of names
+        """
+        return sorted(name for name in os.listdir(self.machines_path) if os.path.isfile(self.config_path(name)))
+
+    def config(self, name):
+        """
+        Get the config of a machine.
+
+        Raises IOError/OSError if the config doesn't exist and ValueError if it can't be parsed.
+
+        :param name: name of the machine
+        :return: dict, same as the output of `docker-machine inspect`
+        """
+        path = self.config_path(name)
+        mtime = os.path.getmtime(path)
+
+        with self._lock:
+            cached = self._configs.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(path) as f:
+            config = json.load(f)
+
+        with self._lock:
+            self._configs[name] = (mtime, config)
+        return config
+
+    def forget(self, name):
+        """
+        Drop the cached config of a machine.
+
+        :param name: name of the machine
+        """
+        with self._lock:
+            self._configs.pop(name, None)
+
+
+_store = None
+
+
+def get_store():
+    """
+    Get the MachineStore for the configured storage path.
+    """
+    global _store
+    if _store is None or _store.path != settings.MACHINERY_STORAGE_PATH:
+        _store = MachineStore(settings.MACHINERY_STORAGE_PATH)
+    return _store
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from django import template
+
+from ..changes import row_hash as _row_hash
+
+register = template.Library()
+
+
+@register.filter
+def row_hash(machine):
+    """
+    Hash of a row in the list of machines, see changes.row_hash.
+    """
+    return _row_hash(machine)
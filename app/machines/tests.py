@@ -3,6 +3,31 @@ from __future__ import absolute_import, print_function, unicode_literals
 from django.test import TestCase
 
 
+def machine(name, state="running", inspect=None, ip="", url=""):
+    """
+    Build a machine like machines_ls does.
+    """
+    from .records import Machine
+    return Machine.from_inspect(name, state, inspect if inspect is not None else {"DriverName": "virtualbox"}, ip, url)
+
+
+class JobLogRootMixin(object):
+    """
+    Writes the job logs of a test to a temporary directory.
+    """
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.test.utils import override_settings
+        super(JobLogRootMixin, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        log_root = override_settings(MACHINERY_JOB_LOG_ROOT=self.path)
+        log_root.enable()
+        self.addCleanup(log_root.disable)
+
+
 # Create your tests here.
 class ConstrucCLIStringTestCase(TestCase):
 
@@ -19,3 +44,1222 @@ class ConstrucCLIStringTestCase(TestCase):
 
         string = construct_cli_string(dic)
         self.assertEquals(string, "--swarm-master --swarm-discovery=token://foo.bar")
+
+
+class LsParserTestCase(TestCase):
+
+    def test_table(self):
+
+        from .core import parse_ls_table
+
+        out = "\n".join([
+            "error in driver during machine creation: boom",
+            "NAME     ACTIVE   DRIVER         STATE     URL                         SWARM                DOCKER    ERRORS",
+            "dev      *        virtualbox     Running   tcp://192.168.99.100:2376   dev (master)         v1.9.1",
+            "agent1   -        amazonec2      Stopped                               dev                  Unknown",
+            "broken            generic        Error                                                      Unknown   ssh: no",
+            "new               none           ",
+        ])
+
+        rows = parse_ls_table(out)
+        self.assertEquals([row.name for row in rows], ["dev", "agent1", "broken", "new"])
+        self.assertEquals(rows[0], ("dev", True, "virtualbox", "running", "tcp://192.168.99.100:2376", "dev (master)"))
+        self.assertEquals(rows[1], ("agent1", False, "amazonec2", "stopped", "", "dev"))
+        self.assertEquals(rows[2].state, "error")
+        self.assertEquals(rows[3].state, "unknown")
+
+    def test_format(self):
+
+        from .core import parse_ls_format
+
+        out = "dev\t*\tvirtualbox\tRunning\ttcp://192.168.99.100:2376\tdev (master)\n\n"
+        self.assertEquals(parse_ls_format(out),
+                          [("dev", True, "virtualbox", "running", "tcp://192.168.99.100:2376", "dev (master)")])
+
+    def test_capabilities(self):
+
+        import mock
+        from . import core
+        from .capabilities import Capabilities, NO_CAPABILITIES
+
+        table = "NAME   ACTIVE   DRIVER       STATE     URL   SWARM\ndev    -        virtualbox   Stopped\n"
+        formatted = "dev\t\tvirtualbox\tStopped\t\t\n"
+        calls = []
+
+        def execute(command, timeout=None):
+            calls.append(command)
+            return 0, formatted if "--format" in command else table, ""
+
+        newer = Capabilities(ls_format=True, ls_filter=True, ls_timeout=True, inspect_many=True)
+        with mock.patch("machines.core.execute", execute):
+            with mock.patch("machines.core.get_capabilities", return_value=NO_CAPABILITIES):
+                self.assertEquals([row.name for row in core.machine_ls_rows()], ["dev"])
+                self.assertEquals(calls[-1], [core.MACHINE_BIN, "ls"])
+                # filters aren't supported, docker-machine isn't even asked
+                self.assertIsNone(core.machine_ls_rows(["name=dev"]))
+                self.assertEquals(len(calls), 1)
+
+            with mock.patch("machines.core.get_capabilities", return_value=newer), \
+                    self.settings(MACHINERY_COMMAND_TIMEOUT=7.5):
+                self.assertEquals([row.name for row in core.machine_ls_rows(["name=dev"])], ["dev"])
+                self.assertEquals(calls[-1][2:6], ["--timeout", "7", "--filter", "name=dev"])
+                self.assertIn("--format", calls[-1])
+
+    def test_from_ls(self):
+
+        from .core import LsRow
+        from .records import Machine
+
+        row = LsRow("dev", False, "virtualbox", "running", "tcp://192.168.99.100:2376", "dev (master)")
+        machine = Machine.from_ls(row)
+        self.assertEquals((machine.ip, machine.swarm_role, machine.swarm_master), ("192.168.99.100", "master", "dev"))
+
+        machine = Machine.from_ls(LsRow("agent1", False, "amazonec2", "stopped", "", "dev"))
+        self.assertEquals((machine.ip, machine.swarm_role, machine.swarm_master), ("", "agent", "dev"))
+
+        machine = Machine.from_ls(LsRow("solo", False, "amazonec2", "stopped", "", ""))
+        self.assertEquals((machine.swarm_role, machine.swarm_master), (None, None))
+
+
+class MachineStoreTestCase(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def write_config(self, name, config, mtime):
+        import json
+        import os
+        directory = os.path.join(self.path, "machines", name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, "config.json")
+        with open(path, "w") as f:
+            json.dump(config, f)
+        os.utime(path, (mtime, mtime))
+
+    def test_names(self):
+
+        import os
+        from .store import MachineStore
+
+        self.write_config("b", {"DriverName": "virtualbox"}, 1000)
+        self.write_config("a", {"DriverName": "virtualbox"}, 1000)
+        # a directory without a config is not a machine
+        os.makedirs(os.path.join(self.path, "machines", "c"))
+
+        store = MachineStore(self.path)
+        self.assertTrue(store.available())
+        self.assertEquals(store.names(), ["a", "b"])
+
+    def test_config_cached_on_mtime(self):
+
+        from .store import MachineStore
+
+        store = MachineStore(self.path)
+        self.write_config("dev", {"DriverName": "virtualbox"}, 1000)
+        config = store.config("dev")
+        self.assertEquals(config["DriverName"], "virtualbox")
+        self.assertIs(store.config("dev"), config)
+
+        self.write_config("dev", {"DriverName": "digitalocean"}, 2000)
+        self.assertEquals(store.config("dev")["DriverName"], "digitalocean")
+
+    def test_missing(self):
+
+        from .store import MachineStore
+
+        store = MachineStore(self.path)
+        self.assertFalse(store.available())
+        self.assertRaises((IOError, OSError), store.config, "dev")
+
+
+class StoreWatcherTestCase(TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, "machines", "dev"))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def watch(self, change=None):
+        import os
+        import threading
+        import time
+        from .watcher import StoreWatcher
+
+        changes = []
+        changed = threading.Event()
+
+        def callback(names):
+            changes.append(names)
+            changed.set()
+
+        watcher = StoreWatcher(self.path, callback, interval=0.1, settle=0.1)
+        watcher.start()
+        try:
+            time.sleep(0.3)
+            if change is None:
+                os.makedirs(os.path.join(self.path, "machines", "new"))
+            else:
+                change()
+            changed.wait(5 if change is None else 1)
+        finally:
+            watcher.stop()
+            watcher.join()
+        return changes
+
+    def test_watch(self):
+        self.assertEquals(self.watch(), [set(["new"])])
+
+    def test_config_only(self):
+        import os
+
+        def write(name):
+            def change():
+                for i in range(4):
+                    with open(os.path.join(self.path, "machines", "dev", name), "a") as f:
+                        f.write("data")
+            return change
+
+        # a running VM writes its disk image all the time
+        self.assertEquals(self.watch(write("disk.vmdk")), [])
+        self.assertEquals(self.watch(write("config.json")), [set(["dev"])])
+
+    def test_poll(self):
+        from . import watcher
+
+        inotify = watcher.Inotify
+
+        def unavailable():
+            raise OSError("inotify is not available")
+
+        watcher.Inotify = unavailable
+        try:
+            self.assertEquals(self.watch(), [set(["new"])])
+        finally:
+            watcher.Inotify = inotify
+
+
+class TransitionalMachinesTestCase(TestCase):
+
+    def test_transitional(self):
+
+        from .core import transitional_machines
+
+        machines = [
+            machine("a"),
+            machine("b", state="unknown"),
+            machine("c", state="stopped"),
+            machine("d", state="starting"),
+            # these don't change on their own
+            machine("e", state="error"),
+            machine("f", state="timeout"),
+        ]
+
+        self.assertEquals(transitional_machines(machines), ["b", "d"])
+
+
+class LastKnownMachinesTestCase(TestCase):
+
+    def setUp(self):
+        from . import core
+        self.refreshes = []
+        self._refresh_in_background = core._refresh_in_background
+        core._refresh_in_background = lambda: self.refreshes.append(True)
+
+    def tearDown(self):
+        from django.core.cache import cache
+        from . import core
+        core._refresh_in_background = self._refresh_in_background
+        cache.delete("machines_ls")
+
+    def set_cache(self, machines, age):
+        import time
+        from django.core.cache import cache
+        cache.set("machines_ls", {"machines": machines, "timestamp": time.time() - age})
+
+    def test_fresh(self):
+
+        from .core import last_known_machines
+
+        self.set_cache([machine("dev")], age=10)
+
+        machines, age = last_known_machines()
+        self.assertEquals(machines, [machine("dev")])
+        self.assertTrue(10 <= age < 20)
+        self.assertEquals(self.refreshes, [])
+
+    def test_stale(self):
+
+        from django.test.utils import override_settings
+        from .core import machines_ls
+
+        self.set_cache([machine("dev")], age=60)
+
+        with override_settings(MACHINERY_INVENTORY_SOFT_TTL=30):
+            self.assertEquals(machines_ls(cached=True), [machine("dev")])
+        self.assertEquals(self.refreshes, [True])
+
+    def test_timeout(self):
+
+        import mock
+        from .core import _build_machines_ls, last_known_machines
+        from .executor import CommandTimeout
+
+        timeout = CommandTimeout(["docker-machine", "ls"], 60)
+        with mock.patch("machines.core.machine_ls_rows", side_effect=timeout):
+            # nothing is known yet, pages render an empty list instead of failing
+            self.assertEquals(last_known_machines(), ([], 0))
+
+            self.set_cache([machine("dev")], age=10)
+            self.assertEquals(_build_machines_ls(), [machine("dev")])
+
+    def test_legacy_entry(self):
+
+        from django.core.cache import cache
+        from .core import _cache_get
+
+        cache.set("machines_ls", [{"name": "dev"}])
+        self.assertEquals(_cache_get(), (None, None))
+
+        # lists of dicts instead of records
+        cache.set("machines_ls", {"machines": [{"name": "dev"}], "timestamp": 0})
+        self.assertEquals(_cache_get(), (None, None))
+
+
+class SingleFlightTestCase(TestCase):
+
+    def test_coalesce(self):
+
+        import threading
+        import time
+        from .core import SingleFlight
+
+        calls = []
+
+        def scan():
+            calls.append(True)
+            time.sleep(0.2)
+            return ["dev"]
+
+        flight = SingleFlight(scan)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight())) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(results, [["dev"]] * 5)
+
+        # the next call runs again
+        flight()
+        self.assertEquals(len(calls), 2)
+
+    def test_error(self):
+
+        from .core import SingleFlight
+
+        def scan():
+            raise ValueError("docker-machine failed")
+
+        self.assertRaises(ValueError, SingleFlight(scan))
+
+
+class RequestMemoTestCase(TestCase):
+
+    def tearDown(self):
+        from django.core.cache import cache
+        from .core import end_request_memo
+        end_request_memo()
+        cache.delete("machines_ls")
+
+    def test_memo(self):
+
+        import time
+        from django.core.cache import cache
+        from .core import begin_request_memo, end_request_memo, machines_ls
+
+        cache.set("machines_ls", {"machines": [machine("dev")], "timestamp": time.time()})
+        begin_request_memo()
+        self.assertEquals(machines_ls(cached=True), [machine("dev")])
+
+        # the cache changes while the request runs, the request keeps seeing the same list
+        cache.set("machines_ls", {"machines": [machine("other")], "timestamp": time.time()})
+        self.assertEquals(machines_ls(cached=True), [machine("dev")])
+
+        end_request_memo()
+        self.assertEquals(machines_ls(cached=True), [machine("other")])
+
+
+class MachineCacheTestCase(TestCase):
+
+    def tearDown(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_set(self):
+
+        from .core import _cache_set, get_inventory
+
+        _cache_set([machine("a"), machine("b")])
+        self.assertEquals(get_inventory().get("b"), machine("b"))
+
+        # machines that are gone aren't found anymore
+        _cache_set([machine("a")])
+        self.assertIsNone(get_inventory().get("b"))
+
+    def test_set_machine(self):
+
+        from .core import _cache_get, _cache_set, _cache_set_machine
+
+        _cache_set([machine("a"), machine("b", state="stopped"), machine("c")])
+
+        _cache_set_machine("b", machine("b"))
+        self.assertEquals(_cache_get()[0], [machine("a"), machine("b"), machine("c")])
+
+        _cache_set_machine("a", None)
+        self.assertEquals([item.name for item in _cache_get()[0]], ["b", "c"])
+
+    def test_refresh_machines(self):
+
+        import mock
+        from .capabilities import Capabilities, NO_CAPABILITIES
+        from .core import _cache_get, _cache_set, refresh_machines
+
+        _cache_set([machine("a"), machine("b"), machine("c")])
+        calls = []
+
+        def execute(command, timeout=None):
+            calls.append(command)
+            return 0, "b\t\tvirtualbox\tStopped\t\t\nd\t\tvirtualbox\tRunning\t\t\n", ""
+
+        newer = Capabilities(ls_format=True, ls_filter=True, ls_timeout=False, inspect_many=False)
+        with mock.patch("machines.core.execute", execute), \
+                mock.patch("machines.core.get_capabilities", return_value=newer):
+            refresh_machines(["d", "b", "c"])
+
+        # only the changed machines are listed, c is gone
+        self.assertIn("name=^(b|c|d)$", calls[0])
+        self.assertEquals([(item.name, item.state) for item in _cache_get()[0]],
+                          [("a", "running"), ("b", "stopped"), ("d", "running")])
+
+        # without filters, all machines are listed
+        del calls[:]
+        with mock.patch("machines.core.execute", execute), \
+                mock.patch("machines.core.get_capabilities", return_value=NO_CAPABILITIES):
+            refresh_machines(["b"])
+        self.assertEquals(calls, [[mock.ANY, "ls"]])
+
+
+class CommandExecutorTestCase(TestCase):
+
+    def test_execute(self):
+
+        from .executor import CommandExecutor
+
+        executor = CommandExecutor(workers=2)
+        returncode, out, err = executor.execute(["echo", "hello"])
+        self.assertEquals(returncode, 0)
+        self.assertEquals(out.strip(), "hello")
+
+    def test_missing_binary(self):
+
+        from .executor import CommandExecutor
+
+        executor = CommandExecutor(workers=1)
+        self.assertRaises(OSError, executor.execute, ["/does/not/exist"])
+
+    def test_lanes(self):
+
+        from .executor import CommandExecutor, BACKGROUND, INTERACTIVE
+
+        executor = CommandExecutor(workers=1)
+        # keep the only worker busy, so that the next commands are queued
+        blocker = executor.submit(["sleep", "0.2"])
+        background = executor.submit(["date", "+%s%N"], lane=BACKGROUND)
+        interactive = executor.submit(["date", "+%s%N"], lane=INTERACTIVE)
+
+        blocker.result()
+        self.assertLess(int(interactive.result()[1]), int(background.result()[1]))
+
+    def test_current_lane(self):
+
+        from .executor import BACKGROUND, INTERACTIVE, current_lane, lane
+
+        self.assertEquals(current_lane(), INTERACTIVE)
+        with lane(BACKGROUND):
+            self.assertEquals(current_lane(), BACKGROUND)
+        self.assertEquals(current_lane(), INTERACTIVE)
+
+
+class CommandTimeoutTestCase(TestCase):
+
+    def test_execute(self):
+
+        import time
+        from .executor import CommandExecutor, CommandTimeout
+
+        executor = CommandExecutor(workers=1)
+        started = time.time()
+        # the child of sh is killed, too. Otherwise communicate() would wait for it
+        self.assertRaises(CommandTimeout, executor.execute, ["sh", "-c", "sleep 5; echo done"], timeout=0.3)
+        self.assertLess(time.time() - started, 3)
+
+    def test_in_time(self):
+
+        from .executor import CommandExecutor
+
+        executor = CommandExecutor(workers=1)
+        self.assertEquals(executor.execute(["echo", "done"], timeout=5)[0], 0)
+
+    def test_run(self):
+
+        from .core import run
+
+        output = list(run(["sh", "-c", "echo started; sleep 5"], timeout=0.3))
+        self.assertEquals(output[0].strip(), "started")
+        self.assertIn("timed out", output[-2])
+        self.assertNotEquals(output[-1], 0)
+
+    def test_lazy_inspect(self):
+
+        import mock
+        from .executor import CommandTimeout
+        from .records import Machine
+
+        # machines are listed without inspecting them, a timeout only shows once the payload is used
+        with mock.patch("machines.core.get_inspect", side_effect=CommandTimeout(["docker-machine", "inspect"], 20)):
+            self.assertEquals(Machine("dev", "running").inspect, {})
+
+    def test_removed_machine(self):
+
+        import mock
+        from .executor import CommandFailed
+        from .core import machine_inspect
+        from .records import Machine
+
+        # the machine is still in the cached list, but docker-machine doesn't know it anymore
+        with mock.patch("machines.core.execute", return_value=(1, "", "Host does not exist: \"dev\"")), \
+                self.settings(MACHINERY_INVENTORY_BACKEND="cli"):
+            self.assertRaises(CommandFailed, machine_inspect, "dev")
+            self.assertEquals(Machine("dev", "running").inspect, {})
+
+
+class JobExecutorTestCase(JobLogRootMixin, TestCase):
+
+    def test_enqueue_once(self):
+
+        from .jobs import JobExecutor
+        from .models import Job
+
+        job = Job.objects.create(name="dev", params={})
+        # no workers, the job stays in the queue
+        executor = JobExecutor(workers=0)
+
+        self.assertTrue(executor.enqueue(job))
+        self.assertFalse(executor.enqueue(job))
+        self.assertTrue(Job.objects.get(pk=job.pk).started)
+
+    def test_cache_refresh_fails(self):
+
+        import mock
+        from .executor import CommandTimeout
+        from .jobs import JobExecutor
+        from .models import Job
+
+        job = Job.objects.create(name="dev", params={}, started=True)
+        with mock.patch("machines.models.run", return_value=iter(["created", 0])), \
+                mock.patch.object(Job, "format_command", return_value=["docker-machine", "create", "dev"]), \
+                mock.patch("machines.models.machines_ls", side_effect=CommandTimeout(["docker-machine", "ls"], 60)), \
+                mock.patch("machines.jobs.notify_finished") as notify_finished:
+            JobExecutor(workers=0)._run(job.pk)
+
+        job = Job.objects.get(pk=job.pk)
+        self.assertEquals((job.finished, job.success), (True, True))
+        self.assertFalse(notify_finished.called)
+
+    def test_fail_interrupted_jobs(self):
+
+        from .jobs import fail_interrupted_jobs
+        from .models import Job
+
+        interrupted = Job.objects.create(name="dev", params={}, started=True)
+        done = Job.objects.create(name="done", params={}, started=True, finished=True, success=True)
+        queued = Job.objects.create(name="queued", params={})
+
+        self.assertEquals(fail_interrupted_jobs(), 1)
+        self.assertEquals(Job.objects.get(pk=interrupted.pk).success, False)
+        self.assertEquals(Job.objects.get(pk=done.pk).success, True)
+        self.assertFalse(Job.objects.get(pk=queued.pk).finished)
+
+
+class JobLogTestCase(JobLogRootMixin, TestCase):
+
+    def test_batching(self):
+
+        from .joblog import JobLog
+
+        log = JobLog(1, flush_size=10, flush_interval=60)
+        log.write("abc\n")
+        # buffered
+        self.assertEquals(log.read(), (b"", 0))
+
+        log.write("defghijk\n")
+        self.assertEquals(log.read(), (b"abc\ndefghijk\n", 13))
+
+        log.write("l\n")
+        log.close()
+        self.assertEquals(log.read(offset=13), (b"l\n", 15))
+
+    def test_interval(self):
+
+        import time
+        from .joblog import JobLog
+
+        log = JobLog(1, flush_size=4096, flush_interval=0.1)
+        log.write("abc\n")
+        time.sleep(0.3)
+        self.assertEquals(log.read(), (b"abc\n", 4))
+        log.close()
+
+    def test_output(self):
+
+        from .models import Job
+
+        job = Job.objects.create(name="dev", params={}, legacy_output="old output")
+        self.assertEquals(job.output, "old output")
+
+        with job.log as log:
+            log.write(b"new output\n")
+        self.assertEquals(job.output, "new output\n")
+
+
+class JobProgressTestCase(JobLogRootMixin, TestCase):
+
+    def test_since(self):
+
+        import json
+        from django.core.urlresolvers import reverse
+        from .models import Job
+
+        job = Job.objects.create(name="dev", params={})
+        url = reverse("machines:job-progress-partial", kwargs={"pk": job.pk})
+
+        with job.log as log:
+            log.write(b"first <line>\n")
+
+        data = json.loads(self.client.get(url, {"since": 0}).content)
+        self.assertEquals(data["content"], "first &lt;line&gt;<br />")
+        self.assertEquals(data["offset"], 13)
+        self.assertFalse(data["finished"])
+
+        with job.log as log:
+            log.write(b"second\n")
+
+        data = json.loads(self.client.get(url, {"since": data["offset"]}).content)
+        self.assertEquals(data["content"], "second<br />")
+        self.assertEquals(data["offset"], 20)
+
+        self.assertEquals(self.client.get(url, {"since": "foo"}).status_code, 400)
+
+
+class JobStreamTestCase(JobLogRootMixin, TestCase):
+
+    def test_stream(self):
+
+        from django.core.urlresolvers import reverse
+        from .models import Job
+
+        job = Job.objects.create(name="dev", params={}, finished=True, success=True)
+        with job.log as log:
+            log.write(b"done\n")
+
+        response = self.client.get(reverse("machines:job-stream", kwargs={"pk": job.pk}))
+        self.assertEquals(response["Content-Type"], "text/event-stream")
+        self.assertEquals(b"".join(response.streaming_content),
+                          b'event: output\nid: 5\ndata: {"content": "done<br />", "offset": 5}\n\n'
+                          b'event: status\ndata: {"finished": true, "success": true}\n\n')
+        response.close()
+
+    def test_stream_limit(self):
+
+        from django.core.urlresolvers import reverse
+        from django.test.utils import override_settings
+        from .models import Job
+        from .views import _stream_slots
+
+        job = Job.objects.create(name="dev", params={}, finished=True, success=True)
+        url = reverse("machines:job-stream", kwargs={"pk": job.pk})
+        with override_settings(MACHINERY_MAX_STREAMS=_stream_slots.open + 1, MACHINERY_STREAM_RETRY=10):
+            first = self.client.get(url)
+            self.assertEquals(first.status_code, 200)
+
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 503)
+            self.assertEquals(response["Retry-After"], "10")
+            self.assertEquals(response.content, b"retry: 10000\n\n")
+
+            # the slot is free again once the first stream is closed
+            first.close()
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            response.close()
+
+    def test_wait_for_change(self):
+
+        import threading
+        from .joblog import change_version, notify_finished, wait_for_change
+
+        version = change_version()
+        threading.Timer(0.1, notify_finished, [4711, True]).start()
+        new_version, changed = wait_for_change(version, 5)
+        self.assertTrue(changed)
+        self.assertEquals(wait_for_change(new_version, 0.01), (new_version, False))
+
+
+class InventoryChangesTestCase(TestCase):
+
+    def test_diff(self):
+
+        from .changes import diff
+
+        previous = [machine("a"), machine("b"), machine("c")]
+        current = [machine("a"), machine("b", state="stopped"), machine("d")]
+
+        change = diff(previous, current)
+        self.assertEquals(change["added"], ["d"])
+        self.assertEquals(change["removed"], ["c"])
+        self.assertEquals([item["name"] for item in change["changed"]], ["b"])
+        self.assertEquals(change["changed"][0]["state"], "stopped")
+
+    def test_record(self):
+
+        from .changes import changes_since, current_version, record
+
+        version = current_version()
+        self.assertEquals(record([machine("a")], [machine("a")]), version)
+        self.assertEquals(changes_since(version), [])
+
+        record([machine("a")], [machine("a"), machine("b")])
+        record([machine("a"), machine("b")], [machine("b")])
+        self.assertEquals(current_version(), version + 2)
+
+        pending = changes_since(version)
+        self.assertEquals([change["version"] for change in pending], [version + 1, version + 2])
+        self.assertEquals(pending[0]["added"], ["b"])
+        self.assertEquals(pending[1]["removed"], ["a"])
+
+        # clients from the future or too far behind have to start over
+        self.assertIsNone(changes_since(version + 3))
+        self.assertIsNone(changes_since(0))
+
+    def test_stream(self):
+
+        import json
+        from django.core.urlresolvers import reverse
+        from django.test.utils import override_settings
+        from .changes import current_version, record
+
+        version = current_version()
+        record([], [machine("a")])
+
+        with override_settings(MACHINERY_STREAM_DURATION=0, MACHINERY_STREAM_HEARTBEAT=0.01):
+            response = self.client.get(reverse("machines:list-stream"), {"version": version})
+            events = b"".join(response.streaming_content).strip().split(b"\n\n")
+            response.close()
+
+        self.assertEquals(len(events), 1)
+        event, id, data = events[0].split(b"\n")
+        self.assertEquals(event, b"event: inventory")
+        self.assertEquals(id, "id: {0}".format(version + 1).encode())
+        self.assertEquals(json.loads(data[len(b"data: "):])["added"], ["a"])
+
+
+class ConditionalPartialTestCase(TestCase):
+
+    def test_list(self):
+
+        import mock
+        from django.core.urlresolvers import reverse
+        from .changes import record
+
+        machines = [machine("machine-{0}".format(i)) for i in range(20)]
+        url = reverse("machines:list-table-partial")
+
+        with mock.patch("machines.views.last_known_machines", return_value=(machines, 0)) as lookup:
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response["Content-Encoding"], "gzip")
+            etag = response["ETag"]
+
+            # the compressed ETag matches as well, the list isn't even read
+            lookup.reset_mock()
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 304)
+            self.assertEquals(response.content, b"")
+            self.assertFalse(lookup.called)
+
+            record(machines, machines[1:])
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 200)
+            self.assertNotEquals(response["ETag"], etag)
+
+    def test_inspect(self):
+
+        import mock
+        from django.core.urlresolvers import reverse
+
+        url = reverse("machines:inspect-partial", kwargs={"name": "a"})
+
+        with mock.patch("machines.views.get_machine_details", return_value=machine("a")):
+            etag = self.client.get(url)["ETag"]
+            self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with mock.patch("machines.views.get_machine_details", return_value=machine("a", state="stopped")):
+            self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class MachinesDeltaTestCase(TestCase):
+
+    def test_merge(self):
+
+        from .changes import merge, summary
+
+        pending = [
+            {"added": ["a"], "removed": ["b"], "changed": []},
+            {"added": ["b"], "removed": ["a"], "changed": [summary(machine("c"))]},
+        ]
+        added, touched = merge(pending)
+        # b was there before it was removed and added again, the client has a row for it
+        self.assertEquals(added, {"a"})
+        self.assertEquals(touched, {"a", "b", "c"})
+
+    def test_delta(self):
+
+        import json
+        import mock
+        from django.core.urlresolvers import reverse
+        from .changes import current_version, record, row_hash
+        from .inventory import Inventory
+
+        before = [machine("a"), machine("b"), machine("c")]
+        after = [machine("b", state="stopped"), machine("c"), machine("d")]
+        version = current_version()
+        record(before, after)
+        url = reverse("machines:list-delta-partial")
+
+        with mock.patch("machines.views.get_inventory", return_value=Inventory().sync(after)):
+            data = json.loads(self.client.get(url, {"version": version}).content.decode())
+
+            self.assertFalse(data["reset"])
+            self.assertEquals(data["version"], version + 1)
+            self.assertEquals(data["removed"], ["a"])
+            self.assertEquals([row["name"] for row in data["added"]], ["d"])
+            self.assertEquals([row["name"] for row in data["changed"]], ["b"])
+            self.assertEquals(data["changed"][0]["hash"], row_hash(after[0]))
+            self.assertIn('data-hash="{0}"'.format(row_hash(after[0])), data["changed"][0]["content"])
+
+            # nothing changed since
+            data = json.loads(self.client.get(url, {"version": version + 1}).content.decode())
+            self.assertEquals(data["added"] + data["changed"] + data["removed"], [])
+
+            data = json.loads(self.client.get(url).content.decode())
+            self.assertTrue(data["reset"])
+            self.assertEquals([row["name"] for row in data["added"]], ["b", "c", "d"])
+
+            self.assertEquals(self.client.get(url, {"version": "x"}).status_code, 400)
+
+
+class LazyContextProcessorTestCase(TestCase):
+
+    def test_lazy(self):
+
+        import mock
+        from django.core.urlresolvers import reverse
+
+        with mock.patch("machines.context_processors.last_known_machines", return_value=([machine("a")], 0)) as lookup:
+            response = self.client.get(reverse("machines:driver"))
+            self.assertEquals(response.status_code, 200)
+            self.assertFalse(lookup.called)
+
+            response = self.client.get(reverse("machines:list"))
+            self.assertTrue(lookup.called)
+            self.assertIn(b'data-name="a"', response.content)
+
+    def test_stream_retry(self):
+
+        from django.core.urlresolvers import reverse
+
+        with self.settings(MACHINERY_STREAM_RETRY=2.5):
+            response = self.client.get(reverse("machines:driver"))
+        self.assertIn(b'data-stream-retry="2500"', response.content)
+
+
+class FragmentCacheTestCase(TestCase):
+
+    def setUp(self):
+
+        from django.core.cache import caches
+        caches["fragments"].clear()
+
+    def test_list(self):
+
+        import json
+        import mock
+        from django.core.urlresolvers import reverse
+        from .changes import record
+
+        url = reverse("machines:list-sidebar-partial")
+
+        with mock.patch("machines.views.render_to_string", return_value="rendered") as render:
+            with mock.patch("machines.views.last_known_machines", return_value=([machine("a")], 0)):
+                self.client.get(url)
+                content = json.loads(self.client.get(url).content.decode())["content"]
+                self.assertEquals(content, "rendered")
+                self.assertEquals(render.call_count, 1)
+
+                record([machine("a")], [machine("a", state="stopped")])
+                self.client.get(url)
+                self.assertEquals(render.call_count, 2)
+
+
+class InventoryAPITestCase(TestCase):
+
+    def get(self, url, **params):
+
+        import json
+        response = self.client.get(url, params)
+        return response.status_code, json.loads(response.content.decode())
+
+    def known(self, machines):
+        """
+        Pretend the list of machines is cached.
+        """
+        import mock
+        from .inventory import Inventory
+
+        for patcher in [
+            mock.patch("machines.core._cache_get_entry", return_value={"machines": machines}),
+            mock.patch("machines.core.last_known_machines", return_value=(machines, 0)),
+            mock.patch("machines.core.get_inventory", return_value=Inventory().sync(machines)),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_list(self):
+
+        import mock
+        from django.core.urlresolvers import reverse
+
+        machines = [
+            machine("c"),
+            machine("a", state="stopped"),
+            machine("d", inspect={"DriverName": "amazonec2"}),
+            machine("b"),
+        ]
+        url = reverse("machines:api-list")
+
+        self.known(machines)
+        status, data = self.get(url, limit=3)
+        self.assertEquals(status, 200)
+        self.assertEquals([item["name"] for item in data["machines"]], ["a", "b", "c"])
+        self.assertNotIn("inspect", data["machines"][0])
+
+        status, data = self.get(url, limit=3, cursor=data["next"])
+        self.assertEquals([item["name"] for item in data["machines"]], ["d"])
+        self.assertIsNone(data["next"])
+
+        # the inventory doesn't keep the inspect payloads, they are loaded together when they are asked for
+        with mock.patch("machines.api.get_inspect_many", return_value={"c": {"DriverName": "virtualbox"}}) as many:
+            status, data = self.get(url, state="running", sort="-driver", inspect=1)
+        self.assertEquals([item["name"] for item in data["machines"]], ["c", "b", "d"])
+        self.assertEquals(data["machines"][0]["inspect"], {"DriverName": "virtualbox"})
+        self.assertEquals(data["machines"][1]["inspect"], {})
+        many.assert_called_once_with(["c", "b", "d"])
+
+        status, data = self.get(url, driver="virtualbox", name="A")
+        self.assertEquals([item["name"] for item in data["machines"]], ["a"])
+
+        status, data = self.get(url, sort="name", limit=1)
+        self.assertEquals(self.get(url, sort="-name", cursor=data["next"])[0], 400)
+        self.assertEquals(self.get(url, sort="ip")[0], 400)
+        self.assertEquals(self.get(url, limit=0)[0], 400)
+        self.assertEquals(self.get(url, cursor="garbage")[0], 400)
+
+    def test_detail(self):
+
+        import mock
+        from django.core.urlresolvers import reverse
+        from .inventory import Inventory
+
+        with mock.patch("machines.api.get_inventory", return_value=Inventory().sync([machine("a")])), \
+                mock.patch("machines.core.execute") as execute:
+            status, data = self.get(reverse("machines:api-detail", kwargs={"name": "a"}))
+            self.assertEquals(status, 200)
+            self.assertEquals(data["driver"], "virtualbox")
+
+            # unknown machines don't run docker-machine
+            self.assertEquals(self.get(reverse("machines:api-detail", kwargs={"name": "b"}))[0], 404)
+            self.assertFalse(execute.called)
+
+        self.assertEquals(self.client.get(reverse("machines:api-list") + "/").status_code, 404)
+
+    def test_search(self):
+
+        from django.core.urlresolvers import reverse
+
+        machines = [machine("web-2"), machine("db"), machine("web"), machine("app-web", state="stopped")]
+        url = reverse("machines:api-search")
+
+        self.known(machines)
+        status, data = self.get(url, q="web")
+        self.assertEquals([item["name"] for item in data["machines"]], ["web", "web-2", "app-web"])
+
+        status, data = self.get(url, q="web", state="running", limit=1)
+        self.assertEquals(data["count"], 2)
+        self.assertEquals([item["name"] for item in data["machines"]], ["web"])
+
+        # same limits as the list
+        self.assertEquals(self.get(url, q="web", limit=0)[0], 400)
+        self.assertEquals(self.get(url, q="web", limit="all")[0], 400)
+
+    def test_pushdown(self):
+
+        import mock
+        from django.core.urlresolvers import reverse
+        from .capabilities import Capabilities, NO_CAPABILITIES
+
+        calls = []
+
+        def execute(command, timeout=None):
+            calls.append(command)
+            if command[1] == "ls":
+                return 0, "web\t\tamazonec2\tRunning\ttcp://10.0.0.1:2376\t\n", ""
+            return 0, {"status": "Running", "url": "tcp://10.0.0.2:2376"}[command[1]], ""
+
+        url = reverse("machines:api-list")
+        newer = Capabilities(ls_format=True, ls_filter=True, ls_timeout=False, inspect_many=True)
+
+        # nothing is cached, only the matching machines are listed
+        with mock.patch("machines.core.execute", execute), \
+                mock.patch("machines.core.get_capabilities", return_value=newer):
+            status, data = self.get(url, driver="amazonec2", state=["running", "stopped"], name="we")
+        self.assertEquals([item["name"] for item in data["machines"]], ["web"])
+        self.assertEquals(len(calls), 1)
+        filters = [calls[0][i + 1] for i, argument in enumerate(calls[0]) if argument == "--filter"]
+        self.assertEquals(filters, ["name=(?i)we", "driver=amazonec2", "state=running", "state=stopped"])
+
+        # older versions don't filter, the configs in the store are checked instead
+        store = mock.Mock()
+        store.available.return_value = True
+        store.names.return_value = ["db", "web"]
+        store.config.side_effect = lambda name: {"DriverName": "amazonec2" if name == "web" else "virtualbox"}
+        del calls[:]
+        with mock.patch("machines.core.execute", execute), \
+                mock.patch("machines.core.get_capabilities", return_value=NO_CAPABILITIES), \
+                mock.patch("machines.core.get_store", return_value=store), \
+                self.settings(MACHINERY_INVENTORY_BACKEND="store"):
+            status, data = self.get(url, driver="amazonec2")
+        self.assertEquals([item["name"] for item in data["machines"]], ["web"])
+        self.assertEquals(data["machines"][0]["ip"], "10.0.0.2")
+        self.assertEquals([command[1:] for command in calls], [["status", "web"], ["url", "web"]])
+
+        # too many machines match, a single ls is faster
+        del calls[:]
+        with mock.patch("machines.core.execute", execute), \
+                mock.patch("machines.core.get_capabilities", return_value=NO_CAPABILITIES), \
+                mock.patch("machines.core.get_store", return_value=store), \
+                self.settings(MACHINERY_INVENTORY_BACKEND="store", MACHINERY_STORE_FILTER_MAX_MACHINES=0):
+            self.get(url, driver="amazonec2")
+        self.assertEquals([command[1:] for command in calls], [["ls"]])
+
+
+class InventoryTestCase(TestCase):
+
+    def swarm(self, name, master):
+        from .records import Machine
+        return Machine(name, "running", driver="virtualbox", swarm_role="master" if name == master else "agent",
+                       swarm_master=master)
+
+    def test_indexes(self):
+
+        from .inventory import Inventory
+
+        inventory = Inventory().sync([
+            self.swarm("master", "master"),
+            self.swarm("agent", "master"),
+            self.swarm("other", "other-master"),
+            machine("a", state="stopped"),
+            machine("b", inspect={"DriverName": "amazonec2"}),
+        ])
+
+        self.assertEquals(len(inventory), 5)
+        self.assertIn("agent", inventory)
+        self.assertEquals(inventory.get("b").driver, "amazonec2")
+        self.assertIsNone(inventory.get("c"))
+
+        names = lambda machines: [item.name for item in machines]
+        self.assertEquals(names(inventory.find(swarm_role="master")), ["master"])
+        self.assertEquals(names(inventory.find(swarm_role=["master", "agent"], swarm_master="master")),
+                          ["master", "agent"])
+        self.assertEquals(names(inventory.find(state="running", driver="virtualbox")), ["master", "agent", "other"])
+        self.assertEquals(names(inventory.find(state="stopped", driver="amazonec2")), [])
+        self.assertEquals(inventory.values("driver"), {"virtualbox": 4, "amazonec2": 1})
+        self.assertRaises(KeyError, inventory.find, ip="10.0.0.1")
+
+    def test_sync(self):
+
+        from .inventory import Inventory
+
+        inventory = Inventory().sync([machine("a"), machine("b")], "1")
+
+        # the same generation is not looked at again
+        inventory.sync([], "1")
+        self.assertEquals(len(inventory), 2)
+
+        inventory.sync([machine("b", state="stopped"), machine("c")], "2")
+        self.assertEquals([item.name for item in inventory], ["b", "c"])
+        self.assertNotIn("a", inventory)
+        self.assertEquals([item.name for item in inventory.find(state="stopped")], ["b"])
+        self.assertEquals(inventory.values("state"), {"stopped": 1, "running": 1})
+
+        # a list that was read before a newer one was written doesn't replace it
+        inventory.sync([machine("a"), machine("b")], "1")
+        self.assertEquals([item.name for item in inventory], ["b", "c"])
+
+    def test_follows_cache(self):
+
+        import time
+        import mock
+        from django.core.cache import cache
+        from .core import GENERATION_KEY, _cache_set, _cache_set_machine, get_inventory
+
+        _cache_set([machine("a"), machine("b")])
+        self.assertEquals([item.name for item in get_inventory()], ["a", "b"])
+
+        _cache_set_machine("b", machine("b", state="stopped"))
+        self.assertEquals(get_inventory().get("b").state, "stopped")
+
+        # as long as the generation doesn't change, the list isn't read
+        with mock.patch("machines.core._cache_get_entry") as entry:
+            get_inventory().get("a")
+        self.assertFalse(entry.called)
+
+        # the list was written by another process
+        generation = (time.time() + 1, "other")
+        cache.set("machines_ls", {"machines": [machine("c")], "timestamp": time.time(), "generation": generation})
+        cache.set(GENERATION_KEY, {"generation": generation, "timestamp": time.time()})
+        self.assertEquals([item.name for item in get_inventory()], ["c"])
+
+    def test_clean_name(self):
+
+        import mock
+        from .forms import MachineForm
+        from .inventory import Inventory
+
+        with mock.patch("machines.forms.get_inventory", return_value=Inventory().sync([machine("a")])):
+            self.assertFalse(MachineForm({"name": "a"}).is_valid())
+            self.assertTrue(MachineForm({"name": "b"}).is_valid())
+
+
+class MachineRecordTestCase(TestCase):
+
+    def test_pickle(self):
+
+        import pickle
+        import mock
+
+        inspect = {"DriverName": "virtualbox", "Driver": {"IPAddress": "10.0.0.1"},
+                   "HostOptions": {"SwarmOptions": {"IsSwarm": True, "Master": True, "Discovery": "token://a"}}}
+        original = machine("a", inspect=inspect, ip="10.0.0.1")
+        self.assertEquals((original.driver, original.swarm_role, original.swarm_master), ("virtualbox", "master", "a"))
+
+        # the inspect payload is not pickled, it's loaded again when it's accessed
+        copy = pickle.loads(pickle.dumps(original, pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(copy, original)
+        self.assertNotIn(b"IPAddress", pickle.dumps(original, pickle.HIGHEST_PROTOCOL))
+        with mock.patch("machines.core.get_inspect", return_value=inspect) as get_inspect:
+            self.assertEquals(copy.inspect, inspect)
+            self.assertEquals(original.inspect, inspect)
+        self.assertEquals(get_inspect.call_count, 1)
+
+        self.assertNotEquals(copy, machine("a", state="stopped", inspect=inspect, ip="10.0.0.1"))
+        self.assertEquals(machine("a", state="timeout").compact().inspect, {})
+
+
+class CapabilitiesTestCase(TestCase):
+
+    def test_probe(self):
+
+        import mock
+        from .capabilities import probe
+
+        old_ls = "Usage: docker-machine ls [OPTIONS] [arg...]\n\nOptions:\n   --quiet, -q\tEnable quiet mode\n"
+        new_ls = old_ls + ("   --filter [--filter option --filter option]\tFilter output\n"
+                           "   --timeout, -t \"10\"\tTimeout in seconds\n"
+                           "   --format, -f \tPretty-print machines using a Go template\n")
+        new_inspect = "Usage: docker-machine inspect [OPTIONS] MACHINE [MACHINE...]\n"
+
+        def answer(ls, inspect):
+            return lambda command, timeout=None: (0, ls if command[1] == "ls" else inspect, "")
+
+        with mock.patch("machines.capabilities.execute", answer(old_ls, "Usage: docker-machine inspect [arg...]")):
+            self.assertEquals(probe("docker-machine"), (False, False, False, False))
+        with mock.patch("machines.capabilities.execute", answer(new_ls, new_inspect)):
+            self.assertEquals(probe("docker-machine"), (True, True, True, True))
+
+    def test_cached_by_mtime(self):
+
+        import os
+        import tempfile
+        import mock
+        from . import capabilities
+
+        binary = tempfile.NamedTemporaryFile()
+        self.addCleanup(capabilities.forget)
+        with mock.patch("machines.capabilities.probe", return_value=capabilities.NO_CAPABILITIES) as probe:
+            capabilities.get_capabilities(binary.name)
+            capabilities.get_capabilities(binary.name)
+            self.assertEquals(probe.call_count, 1)
+
+            # the binary was replaced
+            mtime = os.path.getmtime(binary.name)
+            os.utime(binary.name, (mtime + 10, mtime + 10))
+            capabilities.get_capabilities(binary.name)
+            self.assertEquals(probe.call_count, 2)
+
+        self.assertEquals(capabilities.get_capabilities("/does/not/exist"), capabilities.NO_CAPABILITIES)
+
+    def test_inspect_many(self):
+
+        import mock
+        from .capabilities import Capabilities, NO_CAPABILITIES
+        from .core import get_inspect_many
+
+        calls = []
+
+        def execute(command, timeout=None):
+            calls.append(command)
+            names = command[2:]
+            return 0, "\n".join('{{"Name": "{0}"}}'.format(name) for name in names), ""
+
+        newer = Capabilities(ls_format=True, ls_filter=True, ls_timeout=True, inspect_many=True)
+        with mock.patch("machines.core.execute", execute), self.settings(MACHINERY_INVENTORY_BACKEND="cli"):
+            with mock.patch("machines.core.get_capabilities", return_value=newer):
+                self.assertEquals(get_inspect_many(["a", "b"]), {"a": {"Name": "a"}, "b": {"Name": "b"}})
+                self.assertEquals(len(calls), 1)
+
+            with mock.patch("machines.core.get_capabilities", return_value=NO_CAPABILITIES):
+                self.assertEquals(get_inspect_many(["a", "b"]), {"a": {"Name": "a"}, "b": {"Name": "b"}})
+                self.assertEquals(len(calls), 3)
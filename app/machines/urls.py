@@ -2,7 +2,7 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 from django.conf.urls import url
-from . import views
+from . import api, views
 
 urlpatterns = [
     url(r'^driver/$', views.MachineDriverView.as_view(), name="driver"),
@@ -15,6 +15,12 @@ urlpatterns = [
 
     url(r'^list/partial/sidebar$', views.MachinesSidebarPartialView.as_view(), name="list-sidebar-partial"),
     url(r'^list/partial/table$', views.MachinesListPartialView.as_view(), name="list-table-partial"),
+    url(r'^list/partial/delta$', views.MachinesDeltaPartialView.as_view(), name="list-delta-partial"),
+    url(r'^list/stream$', views.InventoryStreamView.as_view(), name="list-stream"),
+
+    url(r'^api/machines$', api.MachineListAPIView.as_view(), name="api-list"),
+    url(r'^api/search$', api.MachineSearchAPIView.as_view(), name="api-search"),
+    url(r'^api/machines/(?P<name>.+)$', api.MachineDetailAPIView.as_view(), name="api-detail"),
 
     url(r'^add/local/(?P<identifier>[\w]+)/$', views.machine_add_view,
         kwargs={"driver": "local"}, name="add_local"),
@@ -24,6 +30,7 @@ urlpatterns = [
 
     url(r'^job/(?P<pk>[\d]+)/$', views.JobView.as_view(), name="job"),
     url(r'^job/(?P<pk>[\d]+)/json$', views.JobProgressPartialView.as_view(), name="job-progress-partial"),
+    url(r'^job/(?P<pk>[\d]+)/stream$', views.JobStreamView.as_view(), name="job-stream"),
     url(r'^job/run$', views.JobLaunchView.as_view(), name="job-launch"),
     url(r'^job/(?P<pk>[\d]+)/error/$', views.JobErrorView.as_view(), name="job-error"),
 
@@ -1,19 +1,205 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
-from django.views.generic import TemplateView, FormView, DetailView
+import hashlib
+import json
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.views.generic import TemplateView, FormView, DetailView, View
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.gzip import gzip_page
 from django.template.loader import render_to_string
+from django.template.defaultfilters import linebreaksbr
 from django.forms import Form
 from django.contrib import messages
 
 from drivers.models import CLOUD_DRIVER, LOCAL_DRIVER
 
-from .core import machines_ls, machine_rm, get_machine_details
+from .core import machine_rm, get_machine_details, get_inventory, refresh_machines, last_known_machines
 from .forms import MachineForm, SwarmForm, JobForm
 from .models import Job
+from .jobs import get_job_executor
+from .joblog import JobLog, change_version, finished_status, wait_for_change
+from . import changes
+
+
+def sse_event(event, data, id=None):
+    """
+    Format a Server-Sent Event.
+
+    :param event: event name
+    :param data: JSON serializable data
+    :param id: event id, sent back by the browser as Last-Event-ID when it reconnects
+    :return: str
+    """
+    lines = ["event: {0}".format(event)]
+    if id is not None:
+        lines.append("id: {0}".format(id))
+    lines.append("data: {0}".format(json.dumps(data)))
+    return "\n".join(lines) + "\n\n"
+
+
+class StreamSlots(object):
+    """
+    Counts the event streams that are open. Every open stream holds a thread of the server, so their number is limited
+    to leave threads for all other requests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+
+    def acquire(self, limit):
+        """
+        :param limit: maximum number of open streams
+        :return: True if the stream may be opened, it has to be released once it ends
+        """
+        with self._lock:
+            if self.open >= limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+
+_stream_slots = StreamSlots()
+
+
+class StreamEvents(object):
+    """
+    Iterates over the events of a stream and releases its slot once the response is closed.
+    """
+
+    def __init__(self, events):
+        self.events = iter(events)
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.events)
+
+    next = __next__
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        _stream_slots.release()
+        if hasattr(self.events, "close"):
+            self.events.close()
+
+
+def sse_response(events):
+    """
+    Wrap an iterable of events in a streaming response.
+
+    At most MACHINERY_MAX_STREAMS streams are open at the same time. Streams beyond that are answered with 503 and a
+    hint when to try again.
+    """
+    if not _stream_slots.acquire(settings.MACHINERY_MAX_STREAMS):
+        retry = int(settings.MACHINERY_STREAM_RETRY)
+        response = HttpResponse("retry: {0}\n\n".format(retry * 1000), content_type="text/event-stream", status=503)
+        response["Retry-After"] = retry
+        return response
+
+    response = StreamingHttpResponse(StreamEvents(events), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def conditional_json_response(request, etag, render):
+    """
+    Answer a request with JSON, unless the client already has the current version.
+
+    The response is only rendered if the ETag the client sent with If-None-Match doesn't match, otherwise it gets a
+    304 without a body. Compressed responses carry the ETag with a `;gzip` suffix, which is ignored when comparing.
+
+    :param request: django request object
+    :param etag: str version of the resource
+    :param render: callable returning the JSON serializable data, only called if the data is needed
+    :return: response
+    """
+    try:
+        etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+    except ValueError:
+        etags = []
+
+    if etag in [tag[:-len(";gzip")] if tag.endswith(";gzip") else tag for tag in etags]:
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(render())
+    response["ETag"] = quote_etag(etag)
+    # browsers have to ask every time, the ETag keeps that cheap
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def render_fragment(template_name, version, context):
+    """
+    Render a template, unless it was already rendered for the same version of its content.
+
+    :param template_name: name of the template
+    :param version: str or int version of everything the template shows, e.g. the inventory version
+    :param context: dict, only used if the template has to be rendered
+    :return: str
+    """
+    fragments = caches["fragments"]
+    key = "fragment:{0}:{1}".format(template_name, version)
+    content = fragments.get(key)
+    if content is None:
+        content = render_to_string(template_name, context)
+        fragments.set(key, content)
+    return content
+
+
+def machine_etag(machine):
+    """
+    ETag for the details of a single machine.
+
+    :param machine: Machine, or None
+    :return: str
+    """
+    if machine is None:
+        return "missing"
+    details = dict(changes.summary(machine), inspect=machine.inspect)
+    return hashlib.sha1(json.dumps(details, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def inspect_context(name, machine):
+    """
+    Build the context for the inspect templates.
+
+    The driver and the host options are split off the inspect payload. The payload might be shared with the store, so
+    it is copied instead of being modified.
+
+    :param name: name of the machine
+    :param machine: Machine, or None
+    :return: dict
+    """
+    data = {"machine": machine, "machine_name": name}
+    if machine is not None:
+        # the templates use the payload more than once, load it only once
+        machine = data["machine"] = machine.with_inspect()
+        inspect = dict(machine.inspect)
+        # machines that timed out don't have any details
+        data["machine_driver"] = inspect.pop("Driver", {})
+        data["machine_host_opts"] = inspect.pop("HostOptions", {})
+        data["machine_inspect"] = inspect
+    return data
 
 
 class MachineListView(TemplateView):
@@ -26,6 +212,7 @@ class MachineListView(TemplateView):
     def get_context_data(self, **kwargs):
         data = super(MachineListView, self).get_context_data(**kwargs)
         data["table_url"] = reverse("machines:list-table-partial")
+        data["delta_url"] = reverse("machines:list-delta-partial")
         return data
 
 
@@ -38,11 +225,7 @@ class MachineInspectView(TemplateView):
 
     def get_context_data(self, **kwargs):
         data = super(MachineInspectView, self).get_context_data(**kwargs)
-        data["machine"] = get_machine_details(self.kwargs["name"], cached=True)
-        data["machine_name"] = self.kwargs["name"]
-        if data["machine"] is not None:
-            data["machine_driver"] = data["machine"]["inspect"].pop("Driver")
-            data["machine_host_opts"] = data["machine"]["inspect"].pop("HostOptions")
+        data.update(inspect_context(self.kwargs["name"], get_machine_details(self.kwargs["name"], cached=True)))
         data["inspect_url"] = reverse("machines:inspect-partial", kwargs={"name": self.kwargs["name"]})
         return data
 
@@ -144,6 +327,8 @@ class MachineDeleteView(FormView):
             machine_rm(name=self.kwargs["name"], force=True)
             messages.add_message(self.request, messages.ERROR,
                                  'Error removing machine gracefully, had to use force. Log: {0}'.format(output))
+        # update the cache, the list of machines is read from it
+        refresh_machines([self.kwargs["name"]])
         return super(MachineDeleteView, self).form_valid(form)
 
 
@@ -151,9 +336,10 @@ class JobView(DetailView):
     """
     View that holds all information about a Job.
 
-    Adds 3 URLs to the context:
+    Adds 4 URLs to the context:
 
     - poll_url: URL to poll for new output from stdout.
+    - stream_url: URL to stream new output from stdout, for browsers that support Server-Sent Events.
     - launch_url: URL to launch the Job through a request.
     - redirect_url: URL to redirect to if the Job terminated successfully
     """
@@ -165,6 +351,7 @@ class JobView(DetailView):
     def get_context_data(self, **kwargs):
         data = super(JobView, self).get_context_data(**kwargs)
         data["poll_url"] = reverse("machines:job-progress-partial", kwargs={"pk": self.kwargs["pk"]})
+        data["stream_url"] = reverse("machines:job-stream", kwargs={"pk": self.kwargs["pk"]})
         data["launch_url"] = reverse("machines:job-launch")
         data["redirect_url"] = reverse("machines:inspect", kwargs={"name": self.object.name})
         return data
@@ -182,19 +369,88 @@ class JobErrorView(DetailView):
 
 class JobProgressPartialView(DetailView):
     """
-    View that returns the Jobs progress (output) as JSON
+    View that returns the Jobs progress (output) and status as JSON
+
+    With `?since=<offset>`, only the output appended after the byte offset is returned, together with the offset to
+    ask for next time.
     """
 
     model = Job
 
     def render_to_response(self, context, **response_kwargs):
-        data = {"content": render_to_string("machines/include/job.html", {"job": self.object})}
+        data = {"finished": self.object.finished,
+                "success": self.object.success}
+
+        since = self.request.GET.get("since")
+        if since is None:
+            data["content"] = render_to_string("machines/include/job.html", {"job": self.object})
+            return JsonResponse(data)
+
+        try:
+            since = int(since)
+        except ValueError:
+            return HttpResponseBadRequest("since has to be a byte offset")
+
+        output, offset = self.object.log.read(offset=max(since, 0))
+        data["content"] = linebreaksbr(output.decode("utf-8", "replace"), autoescape=True)
+        data["offset"] = offset
         return JsonResponse(data)
 
 
+class JobStreamView(View):
+    """
+    View that streams the Jobs progress as Server-Sent Events.
+
+    Emits `output` events (the output appended to the log, with the byte offset as event id) as soon as the output is
+    written, and a single `status` event once the Job finished. The stream ends after MACHINERY_STREAM_DURATION seconds,
+    browsers reconnect and continue at the offset they got last.
+    """
+
+    def get(self, request, pk):
+        job = get_object_or_404(Job, pk=pk)
+
+        try:
+            offset = int(request.META.get("HTTP_LAST_EVENT_ID") or request.GET.get("since") or 0)
+        except ValueError:
+            return HttpResponseBadRequest("since has to be a byte offset")
+
+        # the stream stays open for minutes, don't hold a database connection while it is idle. Everything else is
+        # read from the log
+        finished, success = job.finished, job.success
+        connection.close()
+
+        return sse_response(self.events(job.pk, offset, finished, success))
+
+    def events(self, pk, offset, finished, success):
+        log = JobLog(pk)
+        version = change_version()
+        started = time.time()
+
+        while True:
+            if not finished:
+                finished, success = finished_status(pk)
+
+            output, offset = log.read(offset=offset)
+            if output:
+                content = linebreaksbr(output.decode("utf-8", "replace"), autoescape=True)
+                yield sse_event("output", {"content": content, "offset": offset}, id=offset)
+
+            if finished:
+                yield sse_event("status", {"finished": True, "success": success})
+                return
+
+            if time.time() - started > settings.MACHINERY_STREAM_DURATION:
+                return
+
+            version, changed = wait_for_change(version, settings.MACHINERY_STREAM_HEARTBEAT)
+            if not changed:
+                # comments keep proxies from closing the connection and let us notice clients that went away
+                yield ": heartbeat\n\n"
+
+
 class JobLaunchView(FormView):
     """
-    View that launches a Job.
+    View that launches a Job. The Job runs in the background, its progress is polled through JobProgressPartialView.
     """
 
     model = Job
@@ -205,41 +461,153 @@ class JobLaunchView(FormView):
         return self.render_to_json_response(job=job)
 
     def render_to_json_response(self, job):
-        data = {"success": job.run()}
+        data = {"queued": get_job_executor().enqueue(job)}
         return JsonResponse(data)
 
 
 class MachinesSidebarPartialView(TemplateView):
     """
     View that returns the sidebar content as JSON
+
+    The inventory version is used as ETag, the content is only rendered if the list of machines changed.
     """
 
-    def render_to_response(self, context, **response_kwargs):
-        data = {"content": render_to_string("machines/include/sidebar.html", {"machines": machines_ls()})}
-        return JsonResponse(data)
+    template_name = "machines/include/sidebar.html"
 
+    @method_decorator(gzip_page)
+    def dispatch(self, request, *args, **kwargs):
+        return super(MachinesSidebarPartialView, self).dispatch(request, *args, **kwargs)
 
-class MachinesListPartialView(TemplateView):
+    def render_to_response(self, context, **response_kwargs):
+        # read the version first. If the list changes in between, the client gets the change once more instead of
+        # missing it
+        version = changes.current_version()
+        # clients that have the current version get a 304, and rendered fragments are reused. The list of machines is
+        # only read if the template is rendered
+        machines = SimpleLazyObject(lambda: last_known_machines()[0])
+        return conditional_json_response(self.request, "inventory-{0}".format(version), lambda: {
+            "content": render_fragment(self.template_name, version, {"machines": machines}),
+            "version": version,
+        })
+
+
+class MachinesListPartialView(MachinesSidebarPartialView):
     """
     View that returns a list of machines as JSON
+
+    The inventory version is used as ETag, the content is only rendered if the list of machines changed.
     """
 
-    def render_to_response(self, context, **response_kwargs):
-        data = {"content": render_to_string("machines/include/list.html", {"machines": machines_ls()})}
+    template_name = "machines/include/list.html"
+
+
+class MachinesDeltaPartialView(View):
+    """
+    View that returns the rows of the list of machines that changed since a version as JSON
+
+    Pass the version the client knows as `?version=`. The response contains the rendered rows of the `added` and
+    `changed` machines together with their row hash, the names of the `removed` machines and the `version` to ask for
+    next time. If the client is too far behind, `reset` is set and all machines are returned as added.
+    """
+
+    row_template_name = "machines/include/list_row.html"
+
+    @method_decorator(gzip_page)
+    def dispatch(self, request, *args, **kwargs):
+        return super(MachinesDeltaPartialView, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request):
+        try:
+            version = int(request.GET["version"])
+        except KeyError:
+            version = None
+        except ValueError:
+            return HttpResponseBadRequest("version has to be an integer")
+
+        # read the changes before the list, like the context processor does
+        current = changes.current_version()
+        pending = changes.changes_since(version) if version is not None else None
+        inventory = get_inventory()
+
+        data = {"version": current, "reset": pending is None, "added": [], "changed": [], "removed": []}
+        if pending is None:
+            data["added"] = [self.row(machine) for machine in inventory]
+            return JsonResponse(data)
+
+        added, touched = changes.merge(pending)
+        for name in sorted(touched):
+            machine = inventory.get(name)
+            if machine is None:
+                data["removed"].append(name)
+            else:
+                data["added" if name in added else "changed"].append(self.row(machine))
         return JsonResponse(data)
 
+    def row(self, machine):
+        row_hash = changes.row_hash(machine)
+        return {"name": machine.name,
+                "hash": row_hash,
+                "content": render_fragment(self.row_template_name, row_hash, {"machine": machine})}
+
+
+class InventoryStreamView(View):
+    """
+    View that streams changes to the list of machines as Server-Sent Events.
+
+    Emits an `inventory` event with the added, removed and changed machines every time the list changes, and a `reset`
+    event if the client is too far behind to catch up. Pass the version the client knows as `?version=`, the version is
+    also sent as event id so that reconnecting browsers continue where they stopped.
+    """
+
+    def get(self, request):
+        try:
+            version = int(request.META.get("HTTP_LAST_EVENT_ID") or request.GET.get("version") or
+                          changes.current_version())
+        except ValueError:
+            return HttpResponseBadRequest("version has to be an integer")
+
+        return sse_response(self.events(version))
+
+    def events(self, version):
+        started = time.time()
+
+        while True:
+            pending = changes.changes_since(version)
+            if pending is None:
+                version = changes.current_version()
+                yield sse_event("reset", {"version": version}, id=version)
+            else:
+                for change in pending:
+                    version = change["version"]
+                    yield sse_event("inventory", change, id=version)
+
+            if time.time() - started > settings.MACHINERY_STREAM_DURATION:
+                return
+
+            latest, changed = changes.wait_for_change(version, settings.MACHINERY_STREAM_HEARTBEAT)
+            if not changed:
+                yield ": heartbeat\n\n"
+
 
 class MachineInspectPartialView(TemplateView):
     """
     View that returns machine details as JSON
+
+    A hash of the machine details is used as ETag, the content is only rendered if the details changed.
     """
 
+    @method_decorator(gzip_page)
+    def dispatch(self, request, *args, **kwargs):
+        return super(MachineInspectPartialView, self).dispatch(request, *args, **kwargs)
+
     def render_to_response(self, context, **response_kwargs):
-        data = {}
-        data["machine"] = get_machine_details(self.kwargs["name"])
-        data["machine_name"] = self.kwargs["name"]
-        if data["machine"] is not None:
-            data["machine_driver"] = data["machine"]["inspect"].pop("Driver")
-            data["machine_host_opts"] = data["machine"]["inspect"].pop("HostOptions")
-        data = {"content": render_to_string("machines/include/inspect.html", data)}
-        return JsonResponse(data)
\ No newline at end of file
+        name = self.kwargs["name"]
+        machine = get_machine_details(name)
+        if machine is not None:
+            # the ETag and the template both need the inspect payload, load it only once
+            machine = machine.with_inspect()
+        etag = machine_etag(machine)
+        return conditional_json_response(self.request, etag, lambda: {
+            "content": render_fragment("machines/include/inspect.html", "{0}:{1}".format(name, etag),
+                                       inspect_context(name, machine))
+        })
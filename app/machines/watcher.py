@@ -0,0 +1,226 @@
+"""
+This module watches the machine store of docker-machine for changes.
+
+Machines that are created, changed or removed outside of machinery (e.g. by running docker-machine on the command line)
+are picked up as soon as their config in `<MACHINE_STORAGE_PATH>/machines` changes. On Linux inotify is used, on every
+other system the store is polled.
+"""
+
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+from .executor import BACKGROUND, lane
+
+logger = logging.getLogger(__name__)
+
+# inotify flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# changes to the machines directory itself, that's where machines are created and removed
+STORE_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF
+# changes to the files of a single machine. Only changes to its config count, other files (e.g. the disk image of a
+# running VM) are written all the time
+MACHINE_MASK = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+MACHINE_CONFIG = "config.json"
+
+# struct inotify_event without the trailing name
+_EVENT = struct.Struct(str("iIII"))
+
+
+class Inotify(object):
+    """
+    Minimal ctypes wrapper around the inotify API of the Linux kernel.
+
+    Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library(str("c")), use_errno=True)
+            init = self.libc.inotify_init
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available")
+
+        self.fd = init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+    def add_watch(self, path, mask):
+        """
+        Watch a path.
+
+        :return: watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+        return wd
+
+    def read(self, timeout):
+        """
+        Wait for events.
+
+        :param timeout: seconds to wait
+        :return: list of tuples (watch descriptor, mask, name), empty if there were no events
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StoreWatcher(threading.Thread):
+    """
+    Thread that watches the machine store and calls `callback` with the set of machine names whose directories
+    changed.
+
+    Bursts of changes (docker-machine writes the config of a new machine several times) are collected until the store
+    settled for `settle` seconds and reported in a single call.
+    """
+
+    def __init__(self, path, callback, interval=2.0, settle=0.5):
+        super(StoreWatcher, self).__init__(name="machinery-store-watcher")
+        self.daemon = True
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.settle = settle
+        self._stopped = threading.Event()
+
+    @property
+    def machines_path(self):
+        return os.path.join(self.path, "machines")
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        with lane(BACKGROUND):
+            self._run()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                inotify = Inotify()
+            except OSError:
+                self._poll()
+                continue
+
+            try:
+                self._watch(inotify)
+            except OSError:
+                logger.exception("Watching %s with inotify failed", self.machines_path)
+                self._stopped.wait(self.interval)
+            finally:
+                inotify.close()
+
+    def _notify(self, names):
+        if not names:
+            return
+        try:
+            self.callback(names)
+        except Exception:
+            logger.exception("Refreshing machines %s failed", ", ".join(sorted(names)))
+
+    def _watch(self, inotify):
+        """
+        Watch the store with inotify. Returns if the machines directory disappears or doesn't exist yet.
+        """
+        if not os.path.isdir(self.machines_path):
+            self._stopped.wait(self.interval)
+            return
+
+        root = inotify.add_watch(self.machines_path, STORE_MASK)
+        machines = {}
+
+        def watch_machine(name):
+            path = os.path.join(self.machines_path, name)
+            if os.path.isdir(path):
+                try:
+                    machines[inotify.add_watch(path, MACHINE_MASK)] = name
+                except OSError:
+                    # the directory was removed in the meantime
+                    pass
+
+        for name in os.listdir(self.machines_path):
+            watch_machine(name)
+
+        changed = set()
+        while not self._stopped.is_set():
+            events = inotify.read(self.settle if changed else self.interval)
+
+            if not events:
+                self._notify(changed)
+                changed = set()
+                continue
+
+            for wd, mask, name in events:
+                if wd == root:
+                    if mask & IN_DELETE_SELF:
+                        self._notify(changed)
+                        return
+                    if mask & IN_ISDIR:
+                        changed.add(name)
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            watch_machine(name)
+                elif mask & IN_IGNORED:
+                    machines.pop(wd, None)
+                elif wd in machines and name == MACHINE_CONFIG:
+                    changed.add(machines[wd])
+
+    def _snapshot(self):
+        """
+        :return: dict, machine name -> mtime of the machines config
+        """
+        snapshot = {}
+        if not os.path.isdir(self.machines_path):
+            return snapshot
+
+        for name in os.listdir(self.machines_path):
+            path = os.path.join(self.machines_path, name)
+            config = os.path.join(path, MACHINE_CONFIG)
+            try:
+                snapshot[name] = os.path.getmtime(config if os.path.exists(config) else path)
+            except OSError:
+                # removed while we were looking at it
+                pass
+        return snapshot
+
+    def _poll(self):
+        """
+        Watch the store by comparing the mtimes of all machine configs every `interval` seconds.
+        """
+        snapshot = self._snapshot()
+        while not self._stopped.wait(self.interval):
+            current = self._snapshot()
+            changed = set(name for name in set(snapshot) | set(current) if snapshot.get(name) != current.get(name))
+            snapshot = current
+            self._notify(changed)
@@ -49,7 +49,8 @@ class HTTPLogger(_cplogging.LogManager):
                  't': self.time(),
                  'r': "%s %s %s" % (environ['REQUEST_METHOD'], environ['REQUEST_URI'], environ['SERVER_PROTOCOL']),
                  's': response.status_code,
-                 'b': str(len(response.content)),
+                 # streaming responses (e.g. event streams) don't have a length
+                 'b': '-' if response.streaming else str(len(response.content)),
                  'f': environ.get('HTTP_REFERER', ''),
                  'a': environ.get('HTTP_USER_AGENT', ''),
         }
@@ -94,6 +95,86 @@ class DjangoAppPlugin(plugins.SimplePlugin):
         cherrypy.tree.mount(static_handler, settings.STATIC_URL)
 
 
+class StoreWatcherPlugin(plugins.SimplePlugin):
+    def __init__(self, bus):
+        """ CherryPy engine plugin that watches the docker-machine
+        store and keeps the machine cache up to date.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+        self.watcher = None
+
+    def start(self):
+        """ When the bus starts, we start watching the machines
+        directory of the docker-machine store. Machines that are
+        created, changed or removed outside of machinery are
+        refreshed in the cache right away.
+        """
+        from machines.core import refresh_machines
+        from machines.watcher import StoreWatcher
+
+        cherrypy.log("Watching the docker-machine store at %s" % settings.MACHINERY_STORAGE_PATH)
+        self.watcher = StoreWatcher(settings.MACHINERY_STORAGE_PATH, refresh_machines,
+                                    interval=settings.MACHINERY_WATCH_INTERVAL)
+        self.watcher.start()
+
+    def stop(self):
+        """ Stop watching when the bus stops.
+        """
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher.join()
+            self.watcher = None
+
+
+class CapabilityProbePlugin(plugins.SimplePlugin):
+    def __init__(self, bus):
+        """ CherryPy engine plugin that probes what the
+        docker-machine binary supports.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+
+    def start(self):
+        """ When the bus starts, we probe docker-machine once so
+        that the first requests don't have to wait for it. The
+        result is kept until the binary changes.
+        """
+        from machines.capabilities import get_capabilities
+        from machines.core import MACHINE_BIN
+
+        capabilities = get_capabilities(MACHINE_BIN)
+        cherrypy.log("docker-machine at %s supports: %s" % (
+            MACHINE_BIN, ", ".join(name for name, value in capabilities._asdict().items() if value) or "nothing new"))
+
+
+class InventoryRefresherPlugin(plugins.SimplePlugin):
+    def __init__(self, bus):
+        """ CherryPy engine plugin that refreshes the list of
+        machines in the background.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+        self.refresher = None
+
+    def start(self):
+        """ When the bus starts, we start refreshing the machine
+        cache on a schedule, so that requests only have to read
+        the cache and never wait for docker-machine.
+        """
+        from machines.refresher import InventoryRefresher
+
+        cherrypy.log("Refreshing the machine cache every %s seconds" % settings.MACHINERY_REFRESH_INTERVAL)
+        self.refresher = InventoryRefresher(interval=settings.MACHINERY_REFRESH_INTERVAL,
+                                            transitional_interval=settings.MACHINERY_REFRESH_TRANSITIONAL_INTERVAL)
+        self.refresher.start()
+
+    def stop(self):
+        """ Stop refreshing when the bus stops.
+        """
+        if self.refresher is not None:
+            self.refresher.stop()
+            self.refresher.join()
+            self.refresher = None
+
+
 def setup():
 
     system = platform.system()
@@ -129,9 +210,14 @@ def setup():
 
     # more import hints that rely on a ready django
 
-    # create the cache table and run a migration
+    # create the cache table and run a migration. Databases created before the machines app had migrations already
+    # have its tables
     call_command('createcachetable')
-    call_command('migrate')
+    call_command('migrate', fake_initial=True)
+
+    # jobs that were running when machinery stopped won't finish anymore
+    from machines.jobs import fail_interrupted_jobs
+    fail_interrupted_jobs()
 
 if __name__ == '__main__':
 
@@ -139,6 +225,8 @@ if __name__ == '__main__':
 
     config = {
         'server.socket_port': 8090,
+        # every open event stream holds a thread, see MACHINERY_MAX_STREAMS
+        'server.thread_pool': settings.MACHINERY_THREAD_POOL,
         'checker.on': False,
         'engine.autoreload.on': False
     }
@@ -149,5 +237,8 @@ if __name__ == '__main__':
     cherrypy.config.update(config)
 
     DjangoAppPlugin(cherrypy.engine).subscribe()
+    StoreWatcherPlugin(cherrypy.engine).subscribe()
+    CapabilityProbePlugin(cherrypy.engine).subscribe()
+    InventoryRefresherPlugin(cherrypy.engine).subscribe()
 
     cherrypy.quickstart()
\ No newline at end of file